@@ -0,0 +1,371 @@
+import asyncio
+import errno
+import os
+import stat
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pyfuse3
+import pyfuse3.asyncio
+
+from freyafs import UNLINKED_PREFIX
+
+# Threads running the operations that may encrypt, decrypt or read
+# fragments: open, read, write, flush, release...
+IO_WORKERS = 32
+
+# Threads running the operations that only need metadata: lookup, getattr,
+# readdir... so that they are never queued behind a flush
+METADATA_WORKERS = 8
+
+# Requests read from the kernel and in flight at any time
+MAX_REQUESTS = 1024
+
+METADATA_OPS = frozenset(('access', 'getattr', 'readdir', 'readlink', 'statfs',
+                          'chmod', 'chown', 'utimens', 'mkdir', 'rmdir', 'symlink',
+                          'mknod'))
+
+
+class AsyncFreyaFS(pyfuse3.Operations):
+    """Serves a FreyaFS from an asyncio event loop on pyfuse3 (libfuse 3).
+
+    The event loop only translates the inodes and file handles of the
+    low-level API into the paths of FreyaFS: every operation still runs in
+    FreyaFS, in one of two bounded thread pools (see IO_WORKERS and
+    METADATA_WORKERS), instead of one thread per request as with fusepy.
+    Mixing and unmixing go on to the crypto executor of MixSlice.
+
+    As libfuse does for fusepy, a file unlinked (or replaced by a rename)
+    while open is only moved away, under UNLINKED_PREFIX, and removed at its
+    last release: its handles keep working until then.
+    """
+
+    enable_writeback_cache = False
+
+    def __init__(self, fs, io_workers=IO_WORKERS, attr_timeout=1.0,
+                 entry_timeout=1.0, kernel_cache=False):
+        super().__init__()
+        self.fs = fs
+        self.attr_timeout = attr_timeout
+        self.entry_timeout = entry_timeout
+        self.kernel_cache = kernel_cache
+        self._io = ThreadPoolExecutor(max_workers=io_workers,
+                                      thread_name_prefix="freyafs-io")
+        self._metadata = ThreadPoolExecutor(max_workers=METADATA_WORKERS,
+                                            thread_name_prefix="freyafs-metadata")
+
+        # Only touched from the event loop: no lock needed
+        self._paths = {pyfuse3.ROOT_INODE: "/"}  # inode -> path
+        self._inodes = {"/": pyfuse3.ROOT_INODE}  # path -> inode
+        self._lookups = {}  # inode -> lookups the kernel did not forget
+        self._next_inode = pyfuse3.ROOT_INODE + 1
+        self._listings = {}  # handle of an open folder -> its entries
+        self._next_handle = 1
+        self._handles = {}  # inode of an open file -> its open handles
+        self._unlinked = set()  # inodes of open files moved away by unlink
+
+        # Left by a mount that ended with unlinked files still open
+        for name in os.listdir(fs.root):
+            if name.startswith(UNLINKED_PREFIX):
+                fs('unlink', "/" + name)
+
+    # --------------------------------------------------------------------- Helpers
+
+    async def _call(self, op, path, *args):
+        """Runs a FreyaFS operation in its thread pool."""
+        pool = self._metadata if op in METADATA_OPS else self._io
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(pool, self.fs, op, path, *args)
+        except OSError as e:
+            raise pyfuse3.FUSEError(e.errno or errno.EIO) from None
+        except Exception:
+            # Anything else would stop pyfuse3.main()
+            traceback.print_exc()
+            raise pyfuse3.FUSEError(errno.EIO) from None
+
+    def _path(self, inode):
+        try:
+            return self._paths[inode]
+        except KeyError:
+            # Its file was removed or replaced
+            raise pyfuse3.FUSEError(errno.ENOENT) from None
+
+    def _child(self, parent_inode, name):
+        parent = self._path(parent_inode)
+        name = os.fsdecode(name)
+        if name == '.':
+            return parent
+        if name == '..':
+            return os.path.dirname(parent)
+        return os.path.join(parent, name)
+
+    def _inode(self, path):
+        """Returns the inode of path, giving it one if it has none."""
+        inode = self._inodes.get(path)
+        if inode is None:
+            inode = self._next_inode
+            self._next_inode += 1
+            self._inodes[path] = inode
+            self._paths[inode] = path
+        return inode
+
+    def _detach(self, path):
+        # The inode stays known to the kernel until it forgets it, but no
+        # longer names anything
+        inode = self._inodes.pop(path, None)
+        if inode is not None and inode != pyfuse3.ROOT_INODE:
+            self._paths.pop(inode, None)
+
+    def _entry(self, path, attrs, lookup=True):
+        """EntryAttributes of a path from the attributes FreyaFS returns,
+        counting a lookup by the kernel."""
+        inode = self._inode(path)
+        if lookup:
+            self._lookups[inode] = self._lookups.get(inode, 0) + 1
+
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = inode
+        entry.generation = 0
+        entry.entry_timeout = self.entry_timeout
+        entry.attr_timeout = self.attr_timeout
+        entry.st_mode = attrs['st_mode']
+        entry.st_nlink = attrs['st_nlink']
+        entry.st_uid = attrs['st_uid']
+        entry.st_gid = attrs['st_gid']
+        entry.st_rdev = 0
+        entry.st_size = attrs['st_size']
+        entry.st_blksize = 4096
+        entry.st_blocks = -(-attrs['st_size'] // 512)
+        entry.st_atime_ns = int(attrs['st_atime'] * 1e9)
+        entry.st_ctime_ns = int(attrs['st_ctime'] * 1e9)
+        entry.st_mtime_ns = int(attrs['st_mtime'] * 1e9)
+        return entry
+
+    async def _lookup(self, path):
+        return self._entry(path, await self._call('getattr', path))
+
+    async def _hide(self, path):
+        """Moves away a file about to be unlinked if it is still open, to be
+        removed at its last release. Returns whether it was open."""
+        inode = self._inodes.get(path)
+        if not self._handles.get(inode):
+            return False
+        hidden = "/" + UNLINKED_PREFIX + str(inode)
+        await self._call('rename', path, hidden)
+        if self._inodes.get(path) == inode:
+            del self._inodes[path]
+        self._inodes[hidden] = inode
+        self._paths[inode] = hidden
+        self._unlinked.add(inode)
+        if not self._handles.get(inode):
+            # Released while it was being moved
+            await self._remove_unlinked(inode)
+        return True
+
+    async def _remove_unlinked(self, inode):
+        self._unlinked.discard(inode)
+        hidden = "/" + UNLINKED_PREFIX + str(inode)
+        self._detach(hidden)
+        await self._call('unlink', hidden)
+
+    # --------------------------------------------------------------------- Inodes
+
+    async def lookup(self, parent_inode, name, ctx):
+        return await self._lookup(self._child(parent_inode, name))
+
+    async def forget(self, inode_list):
+        for inode, nlookup in inode_list:
+            left = self._lookups.get(inode, 0) - nlookup
+            if left > 0:
+                self._lookups[inode] = left
+                continue
+            self._lookups.pop(inode, None)
+            if inode != pyfuse3.ROOT_INODE:
+                path = self._paths.pop(inode, None)
+                if path is not None and self._inodes.get(path) == inode:
+                    del self._inodes[path]
+
+    async def getattr(self, inode, ctx):
+        path = self._path(inode)
+        return self._entry(path, await self._call('getattr', path), lookup=False)
+
+    async def setattr(self, inode, attr, fields, fh, ctx):
+        path = self._path(inode)
+        if fields.update_size:
+            await self._call('truncate', path, attr.st_size)
+        if fields.update_mode:
+            await self._call('chmod', path, stat.S_IMODE(attr.st_mode))
+        if fields.update_uid or fields.update_gid:
+            await self._call('chown', path,
+                             attr.st_uid if fields.update_uid else -1,
+                             attr.st_gid if fields.update_gid else -1)
+        if fields.update_atime or fields.update_mtime:
+            current = await self._call('getattr', path)
+            atime = attr.st_atime_ns if fields.update_atime else int(current['st_atime'] * 1e9)
+            mtime = attr.st_mtime_ns if fields.update_mtime else int(current['st_mtime'] * 1e9)
+            await self._call('utimens', path, (atime / 1e9, mtime / 1e9))
+        return await self.getattr(inode, ctx)
+
+    async def readlink(self, inode, ctx):
+        return os.fsencode(await self._call('readlink', self._path(inode)))
+
+    async def access(self, inode, mode, ctx):
+        try:
+            await self._call('access', self._path(inode), mode)
+        except pyfuse3.FUSEError as e:
+            if e.errno == errno.EACCES:
+                return False
+            raise
+        return True
+
+    async def statfs(self, ctx):
+        stv = await self._call('statfs', "/")
+        data = pyfuse3.StatvfsData()
+        for key in ('f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail',
+                    'f_files', 'f_ffree', 'f_favail', 'f_namemax'):
+            setattr(data, key, stv[key])
+        return data
+
+    # --------------------------------------------------------------------- Folders
+
+    async def opendir(self, inode, ctx):
+        path = self._path(inode)
+        # Listed once: the offsets of the next readdir calls index this list
+        entries = [e for e in await self._call('readdir', path, 0) if isinstance(e, tuple)]
+        handle = self._next_handle
+        self._next_handle += 1
+        self._listings[handle] = (path, entries)
+        return handle
+
+    async def readdir(self, fh, start_id, token):
+        path, entries = self._listings[fh]
+        for index in range(start_id, len(entries)):
+            name, attrs, _ = entries[index]
+            child = os.path.join(path, name)
+            entry = self._entry(child, attrs, lookup=False)
+            if not pyfuse3.readdir_reply(token, os.fsencode(name), entry, index + 1):
+                break
+            # A listed entry counts as a lookup
+            self._lookups[entry.st_ino] = self._lookups.get(entry.st_ino, 0) + 1
+
+    async def releasedir(self, fh):
+        self._listings.pop(fh, None)
+
+    async def mkdir(self, parent_inode, name, mode, ctx):
+        path = self._child(parent_inode, name)
+        await self._call('mkdir', path, mode)
+        return await self._lookup(path)
+
+    async def rmdir(self, parent_inode, name, ctx):
+        path = self._child(parent_inode, name)
+        await self._call('rmdir', path)
+        self._detach(path)
+
+    async def mknod(self, parent_inode, name, mode, rdev, ctx):
+        path = self._child(parent_inode, name)
+        await self._call('mknod', path, mode, rdev)
+        return await self._lookup(path)
+
+    async def symlink(self, parent_inode, name, target, ctx):
+        path = self._child(parent_inode, name)
+        await self._call('symlink', os.fsdecode(target), path)
+        return await self._lookup(path)
+
+    async def unlink(self, parent_inode, name, ctx):
+        path = self._child(parent_inode, name)
+        if await self._hide(path):
+            return
+        await self._call('unlink', path)
+        self._detach(path)
+
+    async def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx):
+        if flags:
+            # RENAME_NOREPLACE and RENAME_EXCHANGE are not supported by FreyaFS
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        old = self._child(parent_inode_old, name_old)
+        new = self._child(parent_inode_new, name_new)
+        if new != old:
+            # An open file replaced by the rename
+            await self._hide(new)
+        await self._call('rename', old, new)
+
+        # Files and folders are moved alike: so are the inodes inside
+        self._detach(new)
+        prefix = old.rstrip("/") + "/"
+        moved = [(path, inode) for path, inode in self._inodes.items()
+                 if path == old or path.startswith(prefix)]
+        for path, inode in moved:
+            del self._inodes[path]
+        for path, inode in moved:
+            renamed = new + path[len(old):]
+            self._inodes[renamed] = inode
+            self._paths[inode] = renamed
+
+    # --------------------------------------------------------------------- Files
+    # The handle of an open file is its inode: FreyaFS keeps open files by path
+
+    def _file_info(self, inode):
+        info = pyfuse3.FileInfo(fh=inode)
+        info.keep_cache = self.kernel_cache
+        self._handles[inode] = self._handles.get(inode, 0) + 1
+        return info
+
+    async def open(self, inode, flags, ctx):
+        await self._call('open', self._path(inode), flags)
+        return self._file_info(inode)
+
+    async def create(self, parent_inode, name, mode, flags, ctx):
+        path = self._child(parent_inode, name)
+        await self._call('create', path, mode)
+        entry = await self._lookup(path)
+        return self._file_info(entry.st_ino), entry
+
+    async def read(self, fh, off, size):
+        data = await self._call('read', self._path(fh), size, off, 0)
+        # Copied: the reply is sent after the thread returns, when the cached
+        # plaintext it points to may have changed or been released
+        return bytes(data)
+
+    async def write(self, fh, off, buf):
+        return await self._call('write', self._path(fh), buf, off, 0)
+
+    async def flush(self, fh):
+        await self._call('flush', self._path(fh), 0)
+
+    async def release(self, fh):
+        try:
+            await self._call('release', self._path(fh), 0)
+        finally:
+            left = self._handles.get(fh, 0) - 1
+            if left > 0:
+                self._handles[fh] = left
+            else:
+                self._handles.pop(fh, None)
+                if fh in self._unlinked:
+                    await self._remove_unlinked(fh)
+
+    async def fsync(self, fh, datasync):
+        await self._call('fsync', self._path(fh), datasync, 0)
+
+    # --------------------------------------------------------------------- Mount
+
+    def close(self):
+        self._io.shutdown()
+        self._metadata.shutdown()
+
+
+def serve(ops, mountpoint):
+    """Mounts ops at mountpoint and serves it until it is unmounted."""
+    options = set(pyfuse3.default_options)
+    options.add('fsname=freyafs')
+
+    pyfuse3.asyncio.enable()
+    pyfuse3.init(ops, mountpoint, options)
+    try:
+        asyncio.run(pyfuse3.main(max_tasks=MAX_REQUESTS))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pyfuse3.close(unmount=True)
+        ops.close()
@@ -0,0 +1,74 @@
+import os
+import threading
+
+# Attributes kept in memory, oldest first out
+ATTR_ENTRIES = 100000
+
+
+class AttrCache:
+    """Attributes and folder listings computed by FreyaFS, kept until one of
+    FreyaFS's own operations changes them.
+
+    Changes made to DATA behind the back of FreyaFS are not seen. Every
+    invalidation bumps an epoch: a result computed while something changed is
+    not stored, so a slow getattr racing with a write never caches stale data.
+    """
+
+    def __init__(self, entries=ATTR_ENTRIES):
+        self.entries = entries
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.attrs = {}
+        self.listings = {}
+
+    def epoch(self):
+        return self._epoch
+
+    def get(self, path):
+        attrs = self.attrs.get(path)
+        return dict(attrs) if attrs is not None else None
+
+    def put(self, path, attrs, epoch):
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self.attrs[path] = dict(attrs)
+            if len(self.attrs) > self.entries:
+                del self.attrs[next(iter(self.attrs))]
+
+    def get_listing(self, path):
+        return self.listings.get(path)
+
+    def put_listing(self, path, names, epoch):
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self.listings[path] = names
+            if len(self.listings) > self.entries:
+                del self.listings[next(iter(self.listings))]
+
+    def forget(self, path):
+        """Forgets the attributes of path alone, e.g. when it is opened."""
+        with self._lock:
+            self._epoch += 1
+            self.attrs.pop(path, None)
+
+    def invalidate(self, *paths):
+        """Forgets paths, and the attributes and listings of their folders."""
+        with self._lock:
+            self._epoch += 1
+            for path in paths:
+                parent = os.path.dirname(path)
+                for p in (path, parent):
+                    self.attrs.pop(p, None)
+                    self.listings.pop(p, None)
+
+    def invalidate_tree(self, path):
+        """Forgets a folder and everything in it."""
+        prefix = os.path.join(path, '')
+        with self._lock:
+            self._epoch += 1
+            for cached in (self.attrs, self.listings):
+                for p in [p for p in cached if p.startswith(prefix)]:
+                    del cached[p]
+        self.invalidate(path)
@@ -0,0 +1,84 @@
+# ALLOCATION PROFILE
+# Measures with tracemalloc how much memory the plaintext paths allocate for
+# one segment: encrypting it from the cached content (the size known, so the
+# padded buffer is allocated once, or not), decrypting it, and serving it to
+# FUSE-sized reads (views of the cached plaintext, or copies). Peaks are
+# reported in multiples of the segment size: a path that copies the plaintext
+# once more shows up as one more segment. Buffers allocated by the aesmix C
+# library are not traced.
+# Run it with: python benchmarks/allocations.py
+
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from filebytecontent import FileByteContent  # noqa: E402
+from mixslice import MixSlice  # noqa: E402
+
+MIB = 1024 * 1024
+READ_SIZE = 128 * 1024  # size of the read requests FUSE sends
+
+
+def profile(fn):
+    """Runs fn, returns the seconds it took and the peak of the memory it
+    allocated (in bytes)."""
+    tracemalloc.start()
+    start = perf_counter()
+    fn()
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def read_all(size, read):
+    served = 0
+    for offset in range(0, size, READ_SIZE):
+        served += len(read(offset, READ_SIZE))
+    return served
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS allocation profile")
+    parser.add_argument('--dir', default=None,
+                        help='folder on the storage to use (default: a temporary folder)')
+    parser.add_argument('--size', type=int, default=16,
+                        help='MiB of plaintext in the segment (default: 16)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="freyafs-alloc-", dir=args.dir)
+    size = args.size * MIB
+    content = FileByteContent(os.urandom(size))
+    key, iv = os.urandom(16), os.urandom(16)
+    path = os.path.join(root, "segment" + MixSlice.PACK_SUFFIX)
+    try:
+        cases = [
+            ("encrypt, size known", lambda: MixSlice.encrypt(
+                content.iter_chunks(), path, key, iv, size=size)),
+            ("encrypt, size unknown", lambda: MixSlice.encrypt(
+                content.iter_chunks(), path, key, iv)),
+            ("decrypt", lambda: MixSlice.decrypt(path, key, iv)),
+            ("reads, views", lambda: read_all(size, content.read_view)),
+            ("reads, copies", lambda: read_all(size, content.read_bytes)),
+        ]
+
+        print(f"{args.size} MiB segment, {READ_SIZE // 1024} KiB reads")
+        print("path                    time (ms)  peak (x segment)")
+        for name, fn in cases:
+            seconds, peak = profile(fn)
+            print(f"{name:<22} {seconds * 1000:10.1f}  {peak / size:16.2f}")
+
+        plaintext = MixSlice.decrypt(path, key, iv)
+        assert plaintext == content.read_all(), "decrypted data differs from the original"
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# CACHE STRESS TEST
+# Hammers the Cache from several threads, each on its own files, to show that
+# I/O on different files proceeds in parallel and that a large flush does not
+# stall reads of other files. Run it with: python benchmarks/cache_stress.py
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from argparse import ArgumentParser
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cache import Cache  # noqa: E402
+from metadata import Info  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def new_file(cache, root, name, size):
+    path = os.path.join(root, name)
+    info = Info(segment_size=cache.segment_size, segments=[])
+    cache.create(path, info)
+    cache.write_bytes(path, os.urandom(size), 0)
+    cache.flush(path)
+    cache.release(path)
+    return path, info
+
+
+def worker(cache, root, name, size, rounds, errors):
+    """Writes, flushes, reopens and checks its own file."""
+    try:
+        path, info = new_file(cache, root, name, size)
+        for i in range(rounds):
+            cache.open(path, info, os.stat(path).st_mtime)
+            data = os.urandom(size // 4)
+            cache.write_bytes(path, data, i * len(data) % size)
+            cache.flush(path)
+            cache.release(path)
+
+            cache.open(path, info, os.stat(path).st_mtime)
+            read = cache.read_bytes(path, i * len(data) % size, len(data))
+            cache.release(path)
+            if read != data:
+                errors.append(f"{name}: read back different data")
+    except Exception as e:
+        errors.append(f"{name}: {e!r}")
+
+
+def scaling(root, threads, size, rounds):
+    cache = Cache(segment_size=4 * MIB)
+    errors = []
+    workers = [threading.Thread(target=worker,
+                                args=(cache, root, f"t{threads}_{i}", size, rounds, errors))
+               for i in range(threads)]
+
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = perf_counter() - start
+
+    moved = threads * (size + rounds * size // 2)  # written + read back
+    return moved / MIB / elapsed, errors
+
+
+def isolation(root, big_size, flushes, readers):
+    """Measures small reads on some files while another one keeps flushing."""
+    cache = Cache(segment_size=4 * MIB)
+    big, big_info = new_file(cache, root, "big", big_size)
+    small = [new_file(cache, root, f"small{i}", 64 * 1024) for i in range(readers)]
+
+    latencies = []
+    done = threading.Event()
+
+    def reader(path, info):
+        cache.open(path, info, os.stat(path).st_mtime)
+        while not done.is_set():
+            start = perf_counter()
+            cache.read_bytes(path, 0, 4096)
+            latencies.append(perf_counter() - start)
+            sleep(0.001)
+        cache.release(path)
+
+    threads = [threading.Thread(target=reader, args=s) for s in small]
+    for t in threads:
+        t.start()
+
+    cache.open(big, big_info, os.stat(big).st_mtime)
+    start = perf_counter()
+    for i in range(flushes):
+        # Dirty every segment, so that each flush rewrites the whole file
+        for offset in range(0, big_size, cache.segment_size):
+            cache.write_bytes(big, b"x", offset)
+        cache.flush(big)
+    flush_time = (perf_counter() - start) / flushes
+    cache.release(big)
+
+    done.set()
+    for t in threads:
+        t.join()
+    return flush_time, latencies
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS cache stress test")
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        help='maximum number of concurrent threads')
+    parser.add_argument('--size', type=int, default=8,
+                        help='MiB per file in the scaling test')
+    parser.add_argument('--rounds', type=int, default=4,
+                        help='write/flush/read rounds per thread')
+    parser.add_argument('--big', type=int, default=64,
+                        help='MiB of the file flushed in the isolation test')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="freyafs-stress-")
+    try:
+        print("threads  MiB/s")
+        counts = sorted({1, 2, 4, args.threads} - {0})
+        failed = []
+        for n in (c for c in counts if c <= max(args.threads, 1)):
+            throughput, errors = scaling(root, n, args.size * MIB, args.rounds)
+            failed.extend(errors)
+            print(f"{n:>7}  {throughput:8.1f}")
+
+        flush_time, latencies = isolation(root, args.big * MIB, 3, 4)
+        print(f"\nfull flush of a {args.big} MiB file: {flush_time * 1000:.0f} ms")
+        print(f"4 KiB reads of other files meanwhile: {len(latencies)} reads, "
+              f"p50 {percentile(latencies, 50) * 1e6:.0f} us, "
+              f"p99 {percentile(latencies, 99) * 1e6:.0f} us")
+
+        if failed:
+            print("\nFAILED:\n  " + "\n  ".join(failed))
+            sys.exit(1)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
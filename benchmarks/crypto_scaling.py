@@ -0,0 +1,101 @@
+# CRYPTO SCALING
+# Measures the aggregate throughput of concurrent encryptions and decryptions
+# of segments (like the flushes and opens of different files by the FUSE
+# threads) against the number of cores used, for each setting of the crypto
+# executor of MixSlice:
+#   threads    N client threads, one aesmix thread per call
+#   library    N client threads, N aesmix threads per call
+#   processes  N client threads, N crypto processes, one aesmix thread each
+# Throughput includes the fragment I/O, as it does in FreyaFS.
+# Run it with: python benchmarks/crypto_scaling.py
+
+import os
+import sys
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mixslice import MixSlice  # noqa: E402
+
+MIB = 1024 * 1024
+
+MODES = {
+    "threads": lambda cores: (1, 0),
+    "library": lambda cores: (cores, 0),
+    "processes": lambda cores: (1, cores),
+}
+
+
+def throughput(fn, jobs, clients, size):
+    """Runs fn over jobs from clients threads, returns the MiB/s."""
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        start = perf_counter()
+        list(pool.map(fn, jobs))
+        seconds = perf_counter() - start
+    return len(jobs) * size / MIB / seconds
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS crypto throughput against cores")
+    parser.add_argument('--dir', default=None,
+                        help='folder on the storage to use (default: a temporary folder)')
+    parser.add_argument('--size', type=int, default=4,
+                        help='MiB of plaintext in each segment (default: 4)')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='segments per core (default: 4)')
+    parser.add_argument('--cores', default=None,
+                        help='comma separated core counts (default: 1, 2, 4... up to the CPUs)')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated settings of the crypto executor')
+    parser.add_argument('--packed', action='store_true',
+                        help='store the segments as packed files')
+    args = parser.parse_args()
+
+    if args.cores:
+        cores = [int(c) for c in args.cores.split(',')]
+    else:
+        cpus = os.cpu_count() or 1
+        cores = sorted({min(1 << i, cpus) for i in range(cpus.bit_length() + 1)})
+
+    root = tempfile.mkdtemp(prefix="freyafs-crypto-", dir=args.dir)
+    size = args.size * MIB
+    data = os.urandom(size)
+    key, iv = os.urandom(16), os.urandom(16)
+    suffix = MixSlice.PACK_SUFFIX if args.packed else ""
+    try:
+        print(f"{args.size} MiB segments, {args.segments} per core, {os.cpu_count()} CPUs")
+        print("mode        cores  encrypt (MiB/s)  decrypt (MiB/s)  speedup")
+        for mode in args.modes.split(','):
+            single = None
+            for n in cores:
+                MixSlice.set_crypto_workers(*MODES[mode](n))
+                paths = [os.path.join(root, f"{mode}-{n}-{i}{suffix}")
+                         for i in range(n * args.segments)]
+                # Starts the crypto processes, if any, before measuring
+                MixSlice.encrypt(data, paths[0], key, iv)
+
+                encrypt = throughput(lambda p: MixSlice.encrypt(data, p, key, iv), paths, n, size)
+                decrypt = throughput(lambda p: MixSlice.decrypt(p, key, iv), paths, n, size)
+                if single is None:
+                    single = encrypt + decrypt
+                print(f"{mode:<11} {n:5d}  {encrypt:15.1f}  {decrypt:15.1f}  "
+                      f"{(encrypt + decrypt) / single:6.2f}x")
+
+                assert MixSlice.decrypt(paths[-1], key, iv) == data, \
+                    "decrypted data differs from the original"
+                for path in paths:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+    finally:
+        MixSlice.set_crypto_workers()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
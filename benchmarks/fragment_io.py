@@ -0,0 +1,68 @@
+# FRAGMENT I/O BENCHMARK
+# Measures how long MixSlice.encrypt (what a flush pays) and MixSlice.decrypt
+# (what an open pays) take for one segment, for several numbers of fragment
+# I/O workers, in either segment layout (--packed). Point --dir to the storage
+# you want to measure (an SSD, a network share, ...).
+# Run it with: python benchmarks/fragment_io.py
+
+import os
+import sys
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mixslice import MixSlice  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def measure(path, data, key, iv, repeat):
+    encrypt, decrypt = [], []
+    for _ in range(repeat):
+        start = perf_counter()
+        MixSlice.encrypt(data, path, key, iv)
+        encrypt.append(perf_counter() - start)
+
+        start = perf_counter()
+        plaintext = MixSlice.decrypt(path, key, iv)
+        decrypt.append(perf_counter() - start)
+        assert plaintext == data, "decrypted data differs from the original"
+    return min(encrypt), min(decrypt)
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS fragment I/O benchmark")
+    parser.add_argument('--dir', default=None,
+                        help='folder on the storage to measure (default: a temporary folder)')
+    parser.add_argument('--size', type=int, default=16,
+                        help='MiB of plaintext in the segment (default: 16)')
+    parser.add_argument('--workers', default='1,2,4,8,16,32',
+                        help='comma separated numbers of I/O workers to try')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per configuration, the best one is reported')
+    parser.add_argument('--packed', action='store_true',
+                        help='store the segment as one packed file instead of a folder')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="freyafs-fragio-", dir=args.dir)
+    data = os.urandom(args.size * MIB)
+    key, iv = os.urandom(16), os.urandom(16)
+    try:
+        print(f"{args.size} MiB segment, {MixSlice.MINI_PER_MACRO} fragments, in {root}")
+        print("workers  flush (ms)  open (ms)")
+        for workers in (int(w) for w in args.workers.split(',')):
+            MixSlice.set_io_workers(workers)
+            path = os.path.join(root, f"w{workers}")
+            if args.packed:
+                path += MixSlice.PACK_SUFFIX
+            encrypt, decrypt = measure(path, data, key, iv, args.repeat)
+            print(f"{workers:>7}  {encrypt * 1000:10.1f}  {decrypt * 1000:9.1f}")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
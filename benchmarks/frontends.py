@@ -0,0 +1,138 @@
+# FRONTENDS
+# Mounts the same volume with each FUSE frontend of FreyaFS and measures many
+# concurrent readers opening and reading whole files, while another thread
+# times stat calls (which must not queue behind the reads):
+#   single   fusepy, one thread
+#   threads  fusepy, one thread per request (-t)
+#   async    pyfuse3 on an asyncio event loop (--async)
+# It needs FUSE (and pyfuse3 for async), and mounts in a temporary folder.
+# Run it with: python benchmarks/frontends.py --readers 256
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(HERE, "..", "main.py")
+MIB = 1024 * 1024
+PASSWORD = "benchmark"
+
+FRONTENDS = {
+    "single": [],
+    "threads": ["-t"],
+    "async": ["--async"],
+}
+
+
+def freyafs(*args, **kwargs):
+    env = dict(os.environ, FREYAFS_BENCHMARK=PASSWORD)
+    return subprocess.Popen([sys.executable, MAIN, *args, "--password-env", "FREYAFS_BENCHMARK"],
+                            env=env, **kwargs)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def unmount(mountpoint):
+    for command in ("fusermount3", "fusermount"):
+        if shutil.which(command):
+            subprocess.run([command, "-u", mountpoint], check=False)
+            return
+    subprocess.run(["umount", mountpoint], check=False)
+
+
+def measure(mountpoint, names, args):
+    """Reads args.reads files from args.readers threads, while timing stats."""
+    latencies, stats = [], []
+    done = threading.Event()
+
+    def read(name):
+        start = perf_counter()
+        with open(os.path.join(mountpoint, name), "rb") as f:
+            size = len(f.read())
+        latencies.append(perf_counter() - start)
+        return size
+
+    def stat_loop():
+        while not done.is_set():
+            start = perf_counter()
+            os.stat(os.path.join(mountpoint, random.choice(names)))
+            stats.append(perf_counter() - start)
+            time.sleep(0.01)
+
+    checker = threading.Thread(target=stat_loop)
+    checker.start()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.readers) as pool:
+        total = sum(pool.map(read, random.choices(names, k=args.reads)))
+    seconds = perf_counter() - start
+    done.set()
+    checker.join()
+    return total / MIB / seconds, latencies, stats
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS frontends under concurrent readers")
+    parser.add_argument('--dir', default=None,
+                        help='folder on the storage to use (default: a temporary folder)')
+    parser.add_argument('--files', type=int, default=64,
+                        help='files in the volume (default: 64)')
+    parser.add_argument('--size', type=int, default=4,
+                        help='MiB per file (default: 4)')
+    parser.add_argument('--readers', type=int, default=128,
+                        help='concurrent reader threads (default: 128)')
+    parser.add_argument('--reads', type=int, default=512,
+                        help='files read in total (default: 512)')
+    parser.add_argument('--frontends', default=','.join(FRONTENDS),
+                        help='comma separated frontends to measure')
+    parser.add_argument('--option', action='append', default=[],
+                        help='extra option of main.py for every mount, e.g. --option=--packed')
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(prefix="freyafs-frontends-", dir=args.dir)
+    source, data, mountpoint = (os.path.join(base, n) for n in ("source", "data", "mount"))
+    os.makedirs(source)
+    os.makedirs(mountpoint)
+    try:
+        names = [f"file{i:04d}" for i in range(args.files)]
+        for name in names:
+            with open(os.path.join(source, name), "wb") as f:
+                f.write(os.urandom(args.size * MIB))
+        freyafs("import", source, data, "--kdf-ops", "1", "--kdf-memory", "8",
+                stdout=subprocess.DEVNULL).wait()
+
+        print(f"{args.files} files of {args.size} MiB, {args.readers} readers, {args.reads} reads")
+        print("frontend   MiB/s  read p50 (s)  read p99 (s)  stat p50 (ms)  stat p99 (ms)")
+        for frontend in args.frontends.split(','):
+            # No kernel caching: every read and stat reaches FreyaFS
+            process = freyafs(mountpoint, data, "--attr-timeout", "0", "--entry-timeout", "0",
+                              *FRONTENDS[frontend], *args.option, stdout=subprocess.DEVNULL)
+            try:
+                deadline = time.monotonic() + 60
+                while not os.path.ismount(mountpoint):
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise SystemExit(f"{frontend}: FreyaFS did not mount")
+                    time.sleep(0.1)
+                throughput, latencies, stats = measure(mountpoint, names, args)
+            finally:
+                unmount(mountpoint)
+                process.wait()
+            print(f"{frontend:<8} {throughput:7.1f}  {percentile(latencies, 0.5):12.3f}  "
+                  f"{percentile(latencies, 0.99):12.3f}  {percentile(stats, 0.5) * 1000:13.2f}  "
+                  f"{percentile(stats, 0.99) * 1000:13.2f}")
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
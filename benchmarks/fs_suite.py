@@ -0,0 +1,321 @@
+# FILESYSTEM BENCHMARK SUITE
+# Drives the Operations of FreyaFS and of the Passthrough baseline directly (no
+# kernel mount needed) through a set of scenarios, and reports throughput,
+# p50/p99 latency and peak RSS for each. Every scenario runs in a process of
+# its own, so that its peak RSS is not inflated by the previous ones. Results
+# are saved as JSON, and --baseline compares them with an older run:
+#   python benchmarks/fs_suite.py --out new.json
+#   python benchmarks/fs_suite.py --out new.json --baseline old.json
+# Options of FreyaFS can be set with --option, e.g. --option writeback_delay=5
+
+import ast
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter, strftime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+MIB = 1024 * 1024
+CHUNK = 128 * 1024  # size of the read and write requests FUSE sends
+PASSWORD = "benchmark"
+
+
+class Recorder:
+    """Times the operations of a scenario."""
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        """Forgets the setup: measures from now on."""
+        self.latencies = []
+        self.bytes = 0
+        self.started = perf_counter()
+
+    def call(self, fn, *args):
+        start = perf_counter()
+        result = fn(*args)
+        self.latencies.append(perf_counter() - start)
+        return result
+
+
+def names(entries):
+    # readdir yields names, or (name, attrs, offset) tuples
+    return [e[0] if isinstance(e, tuple) else e for e in entries]
+
+
+def make_file(fs, path, size):
+    fh = fs.create(path, 0o644)
+    data = os.urandom(CHUNK)
+    for offset in range(0, size, CHUNK):
+        fs.write(path, data, offset, fh)
+    fs.flush(path, fh)
+    fs.release(path, fh)
+
+
+# ------------------------------------------------------------ Scenarios
+# Each scenario gets the filesystem, a Recorder and the arguments. What comes
+# before rec.start() is setup and is not timed.
+
+def seq_write(fs, rec, args):
+    data = os.urandom(CHUNK)
+    fh = rec.call(fs.create, "/seq", 0o644)
+    for offset in range(0, args.size * MIB, CHUNK):
+        rec.bytes += rec.call(fs.write, "/seq", data, offset, fh)
+    rec.call(fs.flush, "/seq", fh)
+    rec.call(fs.release, "/seq", fh)
+
+
+def seq_read(fs, rec, args):
+    make_file(fs, "/seq", args.size * MIB)
+    rec.start()
+    fh = rec.call(fs.open, "/seq", os.O_RDONLY)
+    for offset in range(0, args.size * MIB, CHUNK):
+        rec.bytes += len(rec.call(fs.read, "/seq", CHUNK, offset, fh))
+    rec.call(fs.release, "/seq", fh)
+
+
+def rand_write(fs, rec, args):
+    make_file(fs, "/rand", args.size * MIB)
+    rng = random.Random(0)
+    data = os.urandom(4096)
+    rec.start()
+    fh = rec.call(fs.open, "/rand", os.O_RDWR)
+    for _ in range(args.ops):
+        offset = rng.randrange(0, args.size * MIB // 4096) * 4096
+        rec.bytes += rec.call(fs.write, "/rand", data, offset, fh)
+    rec.call(fs.flush, "/rand", fh)
+    rec.call(fs.release, "/rand", fh)
+
+
+def rand_read(fs, rec, args):
+    make_file(fs, "/rand", args.size * MIB)
+    rng = random.Random(0)
+    rec.start()
+    fh = rec.call(fs.open, "/rand", os.O_RDONLY)
+    for _ in range(args.ops):
+        offset = rng.randrange(0, args.size * MIB // 4096) * 4096
+        rec.bytes += len(rec.call(fs.read, "/rand", 4096, offset, fh))
+    rec.call(fs.release, "/rand", fh)
+
+
+def small_files(fs, rec, args):
+    data = os.urandom(1024)
+    fs.mkdir("/small", 0o755)
+    rec.start()
+    for i in range(args.files):
+        path = f"/small/f{i}"
+        fh = rec.call(fs.create, path, 0o644)
+        rec.bytes += rec.call(fs.write, path, data, 0, fh)
+        rec.call(fs.flush, path, fh)
+        rec.call(fs.release, path, fh)
+
+
+def open_close(fs, rec, args):
+    make_file(fs, "/oc", 64 * 1024)
+    rec.start()
+    for _ in range(args.ops):
+        fh = rec.call(fs.open, "/oc", os.O_RDONLY)
+        rec.call(fs.release, "/oc", fh)
+
+
+def append(fs, rec, args):
+    data = os.urandom(CHUNK)
+    fh = rec.call(fs.create, "/log", 0o644)
+    size = 0
+    while size < args.size * MIB:
+        size += rec.call(fs.write, "/log", data, size, fh)
+        if size % (4 * MIB) == 0:
+            # Like a log that is flushed now and then
+            rec.call(fs.flush, "/log", fh)
+    rec.bytes = size
+    rec.call(fs.flush, "/log", fh)
+    rec.call(fs.release, "/log", fh)
+
+
+def readdir_stat(fs, rec, args):
+    fs.mkdir("/tree", 0o755)
+    for d in range(10):
+        fs.mkdir(f"/tree/d{d}", 0o755)
+        for i in range(args.files // 10):
+            make_file(fs, f"/tree/d{d}/f{i}", 1024)
+    rec.start()
+    for _ in range(3):  # like ls -lR, run again as it would be in practice
+        for folder in names(rec.call(lambda: list(fs.readdir("/tree", None)))):
+            if folder in (".", ".."):
+                continue
+            for name in names(rec.call(lambda: list(fs.readdir(f"/tree/{folder}", None)))):
+                if name not in (".", ".."):
+                    rec.call(fs.getattr, f"/tree/{folder}/{name}")
+
+
+def rename_dir(fs, rec, args):
+    fs.mkdir("/a", 0o755)
+    for i in range(args.files):
+        make_file(fs, f"/a/f{i}", 1024)
+    rec.start()
+    for i in range(args.ops // 10):
+        rec.call(fs.rename, "/a" if i % 2 == 0 else "/b", "/b" if i % 2 == 0 else "/a")
+
+
+SCENARIOS = {f.__name__: f for f in (seq_write, seq_read, rand_write, rand_read, small_files,
+                                     open_close, append, readdir_stat, rename_dir)}
+
+
+# ------------------------------------------------------------ Runner
+
+def mount(kind, root, options):
+    if kind == "passthrough":
+        from passthrough import Passthrough
+        return Passthrough(root)
+
+    from freyafs import FreyaFS
+    with contextlib.redirect_stdout(io.StringIO()):
+        return FreyaFS(root, "(benchmark)", password=PASSWORD, **options)
+
+
+def unmount(fs):
+    if hasattr(fs, "cache"):
+        fs.cache.close()
+        fs.metadata.close()
+
+
+def reset_peak_rss():
+    # The key derivation of the mount alone peaks at about 1 GiB: only the
+    # scenario is of interest (Linux only, ignored elsewhere)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+def run(kind, scenario, args):
+    """Runs one scenario in the current (fresh) process."""
+    root = tempfile.mkdtemp(prefix="freyafs-suite-", dir=args.dir)
+    try:
+        fs = mount(kind, root, args.options)
+        reset_peak_rss()
+        rec = Recorder()
+        SCENARIOS[scenario](fs, rec, args)
+        # Writes still queued in memory are part of the cost
+        unmount(fs)
+        seconds = perf_counter() - rec.started
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        "fs": kind,
+        "scenario": scenario,
+        "ops": len(rec.latencies),
+        "bytes": rec.bytes,
+        "seconds": seconds,
+        "mib_s": rec.bytes / MIB / seconds,
+        "ops_s": len(rec.latencies) / seconds,
+        "p50_us": percentile(rec.latencies, 50) * 1e6,
+        "p99_us": percentile(rec.latencies, 99) * 1e6,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "-C", HERE, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    old = {(r["fs"], r["scenario"]): r for r in baseline["results"]}
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    print("fs           scenario        throughput  p99")
+    for r in results:
+        before = old.get((r["fs"], r["scenario"]))
+        if before is None:
+            continue
+        speed = r["ops_s"] / before["ops_s"] if before["ops_s"] else float("nan")
+        p99 = r["p99_us"] / before["p99_us"] if before["p99_us"] else float("nan")
+        print(f"{r['fs']:<12} {r['scenario']:<14} {speed:>9.2f}x  {p99:.2f}x")
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS benchmark suite")
+    parser.add_argument('--fs', default='passthrough,freyafs',
+                        help='comma separated filesystems to measure')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios to run')
+    parser.add_argument('--size', type=int, default=64,
+                        help='MiB of the files of the sequential, random and append scenarios')
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='operations of the random, open/close and rename scenarios')
+    parser.add_argument('--files', type=int, default=500,
+                        help='files of the small files, readdir and rename scenarios')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='keyword argument of FreyaFS, e.g. segment_size=4194304')
+    parser.add_argument('--dir', default=None,
+                        help='folder on the storage to measure (default: a temporary folder)')
+    parser.add_argument('--out', default=None, help='JSON file to write the results to')
+    parser.add_argument('--baseline', default=None, help='JSON results of an older run')
+    args = parser.parse_args()
+
+    args.options = {}
+    for option in args.option:
+        key, value = option.split("=", 1)
+        args.options[key] = ast.literal_eval(value)
+
+    # A fresh process per scenario: a clean peak RSS, no warm caches
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print("fs           scenario          MiB/s     ops/s   p50 (us)   p99 (us)  RSS (MiB)")
+    for kind in args.fs.split(','):
+        for scenario in args.scenarios.split(','):
+            with context.Pool(1) as pool:
+                r = pool.apply(run, (kind, scenario, args))
+            results.append(r)
+            print(f"{kind:<12} {scenario:<14} {r['mib_s']:8.1f} {r['ops_s']:9.0f} "
+                  f"{r['p50_us']:10.0f} {r['p99_us']:10.0f} {r['peak_rss_mib']:10.1f}")
+
+    report = {
+        "commit": commit(),
+        "date": strftime("%Y-%m-%dT%H:%M:%S"),
+        "arguments": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "option")},
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+# FreyaFS BULK TOOL
+# Imports a plaintext tree into a FreyaFS volume, or exports a volume as a
+# plaintext tree, without mounting it: files are encrypted or decrypted by a
+# pool of processes, and their records are committed in batches. An imported
+# file is written aside and only moved into place once its record is
+# committed, so an interrupted run can be started again and goes on where it
+# stopped. Run it on unmounted volumes (also as: freyafs import / freyafs
+# export / freyafs scrub):
+#   python bulktool.py import SRC DATA
+#   python bulktool.py export DATA DEST
+# It also checks the fragments of every file of a volume against their
+# digests, without unmixing them, and reports the damaged files:
+#   python bulktool.py scrub DATA
+
+import multiprocessing
+import os
+import shutil
+import stat
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from time import perf_counter
+
+from cache import SEGMENT_SIZE, SMALL_SIZE
+from compression import Compression
+from metadata import Info, Metadata, Segment, read_password
+from mixslice import MixSlice
+from smallfile import SmallFile
+
+# Suffix of an exported file being written
+PARTIAL_SUFFIX = ".freyafs-partial"
+
+# Names of the metadata in the root of a volume
+METADATA_PREFIX = ".freyafs"
+
+# Where an import writes the files whose records are not committed yet
+IMPORT_STAGING = METADATA_PREFIX + "-import"
+
+
+def _same_time(st, folder):
+    try:
+        return os.stat(folder).st_mtime_ns == st.st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+# ------------------------------------------------------------ Workers
+# Run in the processes of the pool: one file each.
+
+def encrypt_file(source, folder, info, segment_size, small_size, packed, fsync, compress=None):
+    """Encrypts a plaintext file into the folder of a FreyaFS file, as its
+    first generation. Returns the Info to record."""
+    if os.path.isdir(folder):
+        # Leftover of an interrupted import, never recorded
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    info.generation = 1
+    info.segment_size = segment_size
+    info.segments = []
+    written = []
+    with open(source, "rb") as f:
+        st = os.fstat(f.fileno())
+        if 0 < st.st_size <= small_size:
+            path = SmallFile.path(folder, info.generation)
+            SmallFile.encrypt(f.read(), path, info.key, info.generation)
+            info.small = info.generation
+            written.append(path)
+        else:
+            for index in range(0, -(-st.st_size // segment_size)):
+                data = f.read(segment_size)
+                size, codec = len(data), None
+                if compress is not None:
+                    compressed = Compression.compress(data, size, compress)
+                    if compressed is not None:
+                        data, codec = compressed, compress
+                path = MixSlice.segment_path(folder, index, info.generation)
+                if packed:
+                    path += MixSlice.PACK_SUFFIX
+                iv = MixSlice.segment_iv(info.iv, index, info.generation)
+                digest = MixSlice.encrypt(data, path, info.key, iv, size=len(data))
+                info.segments.append(Segment(size, info.generation, digest, codec))
+                written.append(path)
+    info.size = sum(s.size for s in info.segments) if info.small is None else st.st_size
+
+    if fsync:
+        MixSlice.fsync(written + [folder])
+    # The folder holds the times of the file, and tells a resumed import
+    # whether it is up to date
+    os.utime(folder, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return info
+
+
+def decrypt_file(folder, info, destination):
+    """Decrypts a FreyaFS file into a plaintext file, written aside and
+    renamed into place. Returns its size."""
+    partial = destination + PARTIAL_SUFFIX
+    with open(partial, "wb") as f:
+        if info.small is not None:
+            f.write(SmallFile.decrypt(SmallFile.path(folder, info.small), info.key, info.small))
+        elif info.segments is None:
+            # Legacy single-MixSlice file
+            f.write(MixSlice.decrypt(MixSlice.locate_legacy(folder), info.key, info.iv))
+        else:
+            for index, segment in enumerate(info.segments):
+                path = MixSlice.locate(MixSlice.segment_path(folder, index, segment.version))
+                iv = MixSlice.segment_iv(info.iv, index, segment.version)
+                plaintext = MixSlice.decrypt(path, info.key, iv, digest=segment.digest)
+                if segment.codec is not None:
+                    plaintext = Compression.decompress(plaintext, segment.codec, segment.size)
+                f.write(plaintext)
+        size = f.tell()
+
+    st = os.stat(folder)
+    os.utime(partial, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(partial, destination)
+    return size
+
+
+def scrub_file(folder, info):
+    """Checks the fragments of a FreyaFS file against their digests, and its
+    SecretBox if it is small. Returns the bytes read and the segments that
+    have no digest to check them against."""
+    if info.small is not None:
+        path = SmallFile.path(folder, info.small)
+        SmallFile.decrypt(path, info.key, info.small)
+        return os.path.getsize(path), 0
+
+    if info.segments is None:
+        # Legacy single-MixSlice file
+        segments = [(MixSlice.locate_legacy(folder), None)]
+    else:
+        segments = [(MixSlice.locate(MixSlice.segment_path(folder, index, s.version)), s.digest)
+                    for index, s in enumerate(info.segments)]
+    scanned = unverified = 0
+    for path, digest in segments:
+        scanned += sum(len(f) for f in MixSlice.verify(path, info.key, digest))
+        unverified += digest is None
+    return scanned, unverified
+
+
+# ------------------------------------------------------------ Runner
+
+class Runner:
+    """Runs workers in a pool of processes, with a bounded number of files in
+    flight, and hands their results to a callback in the main process, with
+    the path of the file they worked on."""
+
+    def __init__(self, workers, done):
+        # Forked, not spawned: main.py parses the mount arguments on import
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context("fork"),
+                                        initializer=MixSlice.set_crypto_workers,
+                                        initargs=(1,))
+        self.limit = 4 * workers
+        self.done = done
+        self.running = {}  # future -> path of its file
+        self.failed = 0
+
+    def submit(self, path, fn, *args):
+        while len(self.running) >= self.limit:
+            self._collect(FIRST_COMPLETED)
+        self.running[self.pool.submit(fn, *args)] = path
+
+    def _collect(self, return_when):
+        finished, _ = wait(self.running, return_when=return_when)
+        for future in finished:
+            path = self.running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[!] {path}: {e}")
+                self.failed += 1
+            else:
+                self.done(path, result)
+
+    def finish(self):
+        if self.running:
+            self._collect(ALL_COMPLETED)
+        self.pool.shutdown()
+
+
+def import_tree(source, data, metadata, args):
+    """Encrypts every file of source into the volume data."""
+    pending = []
+    stats = {'files': 0, 'skipped': 0, 'bytes': 0}
+    staging = os.path.join(data, IMPORT_STAGING)
+    if os.path.isdir(staging):
+        # Left by an interrupted run: imported again, as the folders in place
+        # do not have the times of their sources
+        shutil.rmtree(staging)
+
+    def commit():
+        metadata.store(pending)
+        # Only now the folders match their records
+        for path, _ in pending:
+            target = os.path.join(data, path)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.rename(os.path.join(staging, path), target)
+        pending.clear()
+        print(f"[*] Imported {stats['files']} files ({stats['bytes'] / 2**20:.1f} MiB)")
+
+    def done(path, info):
+        pending.append((path, info))
+        stats['files'] += 1
+        stats['bytes'] += info.size
+        if len(pending) >= args.batch:
+            commit()
+
+    runner = Runner(args.workers, done)
+    folders = []
+    try:
+        for folder, dirnames, filenames in os.walk(source):
+            relative = os.path.relpath(folder, source)
+            relative = "" if relative == "." else relative
+            if not relative:
+                dirnames[:] = [d for d in dirnames if not d.startswith(METADATA_PREFIX)]
+                filenames = [f for f in filenames if not f.startswith(METADATA_PREFIX)]
+
+            for name in dirnames:
+                path = os.path.join(folder, name)
+                target = os.path.join(data, relative, name)
+                if os.path.islink(path):
+                    if not os.path.lexists(target):
+                        os.symlink(os.readlink(path), target)
+                    continue
+                os.makedirs(target, exist_ok=True)
+                folders.append((path, target))
+
+            for name in filenames:
+                path = os.path.join(folder, name)
+                target = os.path.join(data, relative, name)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    if not os.path.lexists(target):
+                        os.symlink(os.readlink(path), target)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    print(f"[!] {path}: not a regular file, skipped")
+                    continue
+
+                file_path = os.path.join(relative, name)
+                info = metadata.get(file_path)
+                if info is not None and info.size == st.st_size and _same_time(st, target):
+                    stats['skipped'] += 1
+                    continue
+                runner.submit(file_path, encrypt_file, path, os.path.join(staging, file_path),
+                              Info(), args.segment_size, args.small_size, args.packed,
+                              args.fsync, args.compress)
+        runner.finish()
+    finally:
+        # What was written is recorded, even if interrupted
+        if pending:
+            commit()
+    shutil.rmtree(staging, ignore_errors=True)
+
+    # Last, as creating their content changed them
+    for path, target in reversed(folders):
+        st = os.stat(path)
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    print(f"[*] {stats['files']} files imported, {stats['skipped']} already up to date, "
+          f"{runner.failed} failed")
+    return runner.failed
+
+
+def export_tree(data, destination, metadata, args):
+    """Decrypts every file of the volume data into destination."""
+    stats = {'files': 0, 'skipped': 0, 'bytes': 0}
+
+    def done(path, size):
+        stats['files'] += 1
+        stats['bytes'] += size
+        if stats['files'] % args.batch == 0:
+            print(f"[*] Exported {stats['files']} files ({stats['bytes'] / 2**20:.1f} MiB)")
+
+    runner = Runner(args.workers, done)
+    folders = []
+    os.makedirs(destination, exist_ok=True)
+    for folder, dirnames, filenames in os.walk(data):
+        relative = os.path.relpath(folder, data)
+        relative = "" if relative == "." else relative
+        files = metadata.children(relative)
+
+        subfolders = []
+        for name in dirnames:
+            path = os.path.join(folder, name)
+            target = os.path.join(destination, relative, name)
+            if not relative and name.startswith(METADATA_PREFIX):
+                continue
+            if os.path.islink(path):
+                if not os.path.lexists(target):
+                    os.symlink(os.readlink(path), target)
+                continue
+
+            info = files.get(name)
+            if info is None:
+                os.makedirs(target, exist_ok=True)
+                folders.append((path, target))
+                subfolders.append(name)
+                continue
+
+            # The folder of a file
+            st = os.stat(path)
+            try:
+                same = os.stat(target).st_size == info.size and _same_time(st, target)
+            except FileNotFoundError:
+                same = False
+            if same:
+                stats['skipped'] += 1
+                continue
+            runner.submit(os.path.join(relative, name), decrypt_file, path, info, target)
+        dirnames[:] = subfolders
+
+        for name in filenames:
+            path = os.path.join(folder, name)
+            if not relative and name.startswith(METADATA_PREFIX):
+                continue
+            target = os.path.join(destination, relative, name)
+            if os.path.islink(path) and not os.path.lexists(target):
+                os.symlink(os.readlink(path), target)
+    runner.finish()
+
+    for path, target in reversed(folders):
+        st = os.stat(path)
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    print(f"[*] {stats['files']} files exported, {stats['skipped']} already up to date, "
+          f"{runner.failed} failed")
+    return runner.failed
+
+
+def scrub_tree(data, metadata, args):
+    """Checks every file of the volume data, reporting the damaged ones."""
+    stats = {'files': 0, 'bytes': 0, 'unverified': 0}
+    start = perf_counter()
+
+    def report():
+        seconds = perf_counter() - start
+        print(f"[*] Checked {stats['files']} files ({stats['bytes'] / 2**20:.1f} MiB, "
+              f"{stats['bytes'] / 2**20 / seconds if seconds else 0:.1f} MiB/s)")
+
+    def done(path, result):
+        scanned, unverified = result
+        stats['files'] += 1
+        stats['bytes'] += scanned
+        stats['unverified'] += unverified
+        if unverified:
+            print(f"[?] {path}: {unverified} segments written before digests, not verified")
+        if stats['files'] % args.batch == 0:
+            report()
+
+    runner = Runner(args.workers, done)
+    for folder, dirnames, filenames in os.walk(data):
+        relative = os.path.relpath(folder, data)
+        relative = "" if relative == "." else relative
+        files = metadata.children(relative)
+
+        subfolders = []
+        for name in dirnames:
+            info = files.get(name)
+            if info is None:
+                if not os.path.islink(os.path.join(folder, name)):
+                    subfolders.append(name)
+                continue
+            runner.submit(os.path.join(relative, name), scrub_file,
+                          os.path.join(folder, name), info)
+        dirnames[:] = subfolders
+    runner.finish()
+
+    report()
+    print(f"[*] {stats['files'] + runner.failed} files scrubbed, {runner.failed} damaged, "
+          f"{stats['unverified']} segments without a digest")
+    return runner.failed
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS bulk import and export")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help='encrypt a plaintext tree into a volume')
+    command.add_argument('source', metavar='SRC', help='folder to import')
+    command.add_argument('data', metavar='DATA', help='folder containing your encrypted files')
+    command.add_argument('--segment-size', metavar='MIB', type=int,
+                         default=SEGMENT_SIZE // (1024 * 1024),
+                         help='size in MiB of the independently mixed segments (default: 16)')
+    command.add_argument('--small-size', metavar='KIB', type=int,
+                         default=SMALL_SIZE // 1024,
+                         help='store files up to KiB as a single SecretBox, 0 to disable (default: 16)')
+    command.add_argument('--packed', action='store_true',
+                         help='store each segment as one packed file')
+    command.add_argument('--fsync', action='store_true',
+                         help='fsync the fragments of a file before recording it')
+    command.add_argument('--compress', metavar='CODEC', choices=Compression.CODECS, default=None,
+                         help='compress the segments that compress with CODEC (zlib, lzma or zstd)')
+    command.add_argument('--kdf-ops', metavar='N', type=int, default=None,
+                         help='Argon2id operations of the key derivation of a new volume')
+    command.add_argument('--kdf-memory', metavar='MIB', type=int, default=None,
+                         help='Argon2id memory in MiB of the key derivation of a new volume')
+
+    command = commands.add_parser('export', help='decrypt a volume into a plaintext tree')
+    command.add_argument('data', metavar='DATA', help='folder containing your encrypted files')
+    command.add_argument('destination', metavar='DEST', help='folder to write the files to')
+
+    command = commands.add_parser('scrub', help='check the fragments of a volume against their digests')
+    command.add_argument('data', metavar='DATA', help='folder containing your encrypted files')
+
+    for command in commands.choices.values():
+        command.add_argument('--workers', metavar='N', type=int, default=os.cpu_count() or 1,
+                             help='processes encrypting, decrypting or checking files (default: one per CPU)')
+        command.add_argument('--batch', metavar='N', type=int, default=1000,
+                             help='files per metadata commit and progress report (default: 1000)')
+        password = command.add_mutually_exclusive_group()
+        password.add_argument('--password-fd', metavar='FD', type=int, default=None,
+                              help='read the password from the first line of file descriptor FD')
+        password.add_argument('--password-env', metavar='VAR', default=None,
+                              help='read the password from the environment variable VAR')
+        password.add_argument('--keyfile', metavar='PATH', default=None,
+                              help='use the content of PATH as the password')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        if args.segment_size <= 0:
+            parser.error("--segment-size must be at least 1")
+        if args.small_size * 1024 >= args.segment_size * 1024 * 1024:
+            parser.error("--small-size must be smaller than --segment-size")
+        if args.compress and not Compression.available(args.compress):
+            parser.error(f"--compress {args.compress} needs the zstandard package")
+
+    try:
+        password = read_password(args.password_fd, args.password_env, args.keyfile)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == 'import':
+        args.segment_size *= 1024 * 1024
+        args.small_size *= 1024
+        os.makedirs(args.data, exist_ok=True)
+        memlimit = args.kdf_memory * 1024 * 1024 if args.kdf_memory is not None else None
+        metadata = Metadata(os.path.join(args.data, METADATA_PREFIX), password,
+                            args.kdf_ops, memlimit)
+    else:
+        metadata = Metadata(os.path.join(args.data, METADATA_PREFIX), password)
+
+    try:
+        if args.command == 'import':
+            failed = import_tree(args.source, args.data, metadata, args)
+        elif args.command == 'export':
+            failed = export_tree(args.data, args.destination, metadata, args)
+        else:
+            failed = scrub_tree(args.data, metadata, args)
+    except KeyboardInterrupt:
+        print(f"\n[!] Interrupted: run the same command again to resume the {args.command}")
+        return 1
+    finally:
+        metadata.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,132 +1,991 @@
 import os
+import shutil
 import threading
-from time import time
-
-from filebytecontent import FileByteContent
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, time
+
+from compression import Compression
+from filebytecontent import CHUNK_SIZE, FileByteContent
+from metadata import Segment
+from metrics import METRICS, TimedLock
 from mixslice import MixSlice
+from smallfile import SmallFile
+from spill import Spill
+
+# Default amount of plaintext mixed together in a single MixSlice
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+# Files up to this size are stored as a single SecretBox instead of a MixSlice
+SMALL_SIZE = 16 * 1024
+
+# In write-back mode, dirty bytes that trigger an immediate write-back
+WRITEBACK_BYTES = 64 * 1024 * 1024
+
+# A failed write-back is retried after this many seconds, twice as long after
+# every further failure, up to WRITEBACK_RETRY_MAX
+WRITEBACK_RETRY = 1.0
+WRITEBACK_RETRY_MAX = 60.0
+
+# Read-ahead: at most this many segments are decrypted ahead of a sequential
+# reader, with at most this many bytes of them in flight at any time, by a
+# pool of this many threads
+READAHEAD = 4
+READAHEAD_BYTES = 64 * 1024 * 1024
+READAHEAD_WORKERS = 2
+
+# A read that starts this close to where the previous one ended is sequential
+# (the kernel may reorder the requests of a reader a little)
+READAHEAD_SLACK = 256 * 1024
+
+# Streaming: threads mixing the segments of sequential writers as soon as
+# they are complete
+STREAM_WORKERS = 2
+
+# Folder, inside the folder of a file, where new segments are written before
+# being renamed into place
+STAGING = ".staging"
+
 
-LOCK = threading.Lock()
+def _remove(path):
+    """Removes a file or a folder, if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
 
 
 class CacheEntry:
-    def __init__(self, path, content, mtime=None):
+    def __init__(self, path, content, info, mtime=None):
         self.path = path
 
         self.content = content
+        self.info = info
         self.opens = 1  # number of concurrent apps with this file open
         self.modified = True if not mtime else False
         self.atimes = int(time())
         self.mtimes = self.atimes if not mtime else mtime
 
+        # Segments still on disk, not yet decrypted into content
+        self.missing = set()
+        # Bytes written since the last encryption (write-back accounting)
+        self.dirty_bytes = 0
+        # Write-backs that failed in a row (index lock)
+        self.failures = 0
+        # Plaintext bytes of it counted in Cache.memory_used (index lock)
+        self.in_memory = 0
+        # Smallest length the file was truncated to since the last encryption:
+        # the stored segments past it are stale, even if it grew back since
+        self.truncated = None
+
+        # Read-ahead state (index lock): where a sequential reader should read
+        # next, the last segment it reached, how many segments to decrypt
+        # ahead of it, and the segments being decrypted (index -> future)
+        self.next_read = 0
+        self.last_segment = -1
+        self.window = 0
+        self.prefetching = {}
+
+        # Streaming state (entry.lock): the next segment to hand to the
+        # background once the writer moves past it (None: not a sequential
+        # writer), the segments being mixed (index -> (future, their chunks))
+        # and those already staged for the next flush (index -> Segment)
+        self.stream_next = None
+        self.streaming = {}
+        self.streamed = {}
+
+        # Serializes loading, writing, encrypting and renaming this file.
+        # The index lock of the cache may be taken while holding it, never
+        # the other way round.
+        self.lock = TimedLock("entry", threading.RLock())
+        # Set once the entry left the cache (removed, evicted, failed to load)
+        self.removed = False
+
 
 class Cache:
-    def __init__(self):
+    def __init__(self, segment_size=SEGMENT_SIZE, writeback_delay=None,
+                 writeback_bytes=WRITEBACK_BYTES, cache_bytes=0, fsync=False,
+                 packed=False, small_size=SMALL_SIZE, persist=None,
+                 readahead=READAHEAD, readahead_bytes=READAHEAD_BYTES,
+                 spill_size=None, memory_bytes=0, spill_dir=None, verify=False,
+                 stream=0, compress=None, written=None):
+        if segment_size <= 0 or segment_size % MixSlice.MACRO_SIZE:
+            raise ValueError(f"segment size must be a positive multiple of {MixSlice.MACRO_SIZE}")
+        if small_size >= segment_size:
+            raise ValueError("small files must be smaller than a segment")
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.packed = packed
+        self.small_size = small_size
+        # Codec segments are compressed with before being mixed (None: never)
+        self.compress = compress
+        # Called with the info of a file after it is encrypted, to save the
+        # metadata pointing to its new segments
+        self.persist = persist
+        # Called with the path of a file once a write-back restored its times,
+        # so that attributes read before are not kept
+        self.written = written
+
+        # The index lock only protects the dictionaries and counters below:
+        # it is never held while decrypting, encrypting or doing file I/O
+        self._lock = TimedLock("cache")
         self.files = {}
 
+        # Segments (and legacy fragments) replaced by a flush. The metadata
+        # saved on disk may still point to them, so they are only deleted by
+        # reclaim(), once the new metadata is persisted (right after the flush
+        # if there is a persist callback).
+        self.garbage = set()
+
+        # Clean files nobody has open, kept in LRU order (path -> plaintext
+        # bytes in memory) so that reopening them needs no decryption
+        self.cache_bytes = cache_bytes
+        self.idle = OrderedDict()
+        self.idle_bytes = 0
+
+        # The plaintext of files of spill_size bytes or more, or of files that
+        # would take the plaintext held in memory past memory_bytes, lives in
+        # memory-mapped files in spill_dir instead (None, 0: never)
+        self.spill_size = spill_size
+        self.memory_bytes = memory_bytes
+        self.spill_dir = spill_dir
+        # Plaintext bytes of the cached files that are not spilled
+        self.memory_used = 0
+
+        # Opening a file checks the fragments of all its segments against
+        # their digests first, to fail with EIO before reading any of it
+        self.verify = verify
+
+        # Streaming: the segments a sequential writer completes are mixed and
+        # staged in the background right away, up to stream of them in flight
+        # per file, and their plaintext is dropped (0 to disable). Needs
+        # segments made of whole chunks, larger than small files.
+        self.stream = stream if segment_size % CHUNK_SIZE == 0 and segment_size > small_size else 0
+        self._streamer = None
+
+        # Sequential readers get the next segments decrypted in the background
+        # (up to readahead of them, 0 to disable)
+        self.readahead = readahead
+        self.readahead_bytes = readahead_bytes
+        self.readahead_inflight = 0
+        self._prefetcher = None
+
+        # Write-back mode: flush() only queues the file, and a background
+        # thread encrypts it once its delay expires (or too much is dirty)
+        self.writeback_delay = writeback_delay
+        self.writeback_bytes = writeback_bytes
+        self.pending = {}  # path -> deadline of the write-back
+        # Files being encrypted by a write-back: they stay in files until it
+        # is over, so that a reopen does not sweep the segments it stages
+        self.writing = set()
+        self.dirty_bytes = 0
+        self._wakeup = threading.Condition(self._lock)
+        self._closing = False
+        self._flusher = None
+        if writeback_delay is not None:
+            self._flusher = threading.Thread(target=self._writeback_loop,
+                                             name="freyafs-writeback",
+                                             daemon=True)
+            self._flusher.start()
+
     def __contains__(self, path):
-        return path in self.files
+        # Files in the LRU are only there to speed up the next open
+        with self._lock:
+            return path in self.files and path not in self.idle
 
     # ------------------------------------------------------ Helpers
 
-    def _decrypt(self, path, key, iv):
-        return MixSlice.decrypt(path, key, iv)
+    def _get(self, path):
+        with self._lock:
+            return self.files.get(path)
+
+    def _segments_in(self, entry, offset, length):
+        """Returns the indices of the stored segments overlapping a range."""
+        if not entry.missing or length <= 0:
+            return []
+        size = entry.info.segment_size
+        first = offset // size
+        last = (offset + length - 1) // size
+        return [i for i in range(first, last + 1) if i in entry.missing]
+
+    def _load(self, entry, offset, length):
+        """Decrypts the stored segments that overlap a range, if needed."""
+        if not self._segments_in(entry, offset, length):
+            METRICS.inc("cache_hits_total", kind="segment")
+            return
+
+        with entry.lock:
+            for index in self._segments_in(entry, offset, length):
+                METRICS.inc("cache_misses_total", kind="segment")
+                plaintext = self._decrypt(entry, index)
+                entry.content.fill(plaintext, index * entry.info.segment_size)
+                entry.missing.discard(index)
+
+    def _read_ahead(self, entry, offset, length):
+        """Follows the reads of a file and, while they are sequential, queues
+        the decryption of the next segments. The window doubles every time
+        the reader reaches a new segment, and closes on a random read."""
+        if not self.readahead or length <= 0:
+            return
+
+        with self._lock:
+            sequential = abs(offset - entry.next_read) <= READAHEAD_SLACK
+            entry.next_read = offset + length
+            if not sequential:
+                entry.window = 0
+                entry.last_segment = -1
+                return
+            if not entry.missing or self._closing:
+                return
 
-    def _encrypt(self, path, key, iv):
-        plaintext = self.files[path].content.read_all()
-        MixSlice.encrypt(plaintext, path, key, iv)
+            current = (offset + length - 1) // entry.info.segment_size
+            if current <= entry.last_segment:
+                return
+            entry.last_segment = current
+            entry.window = min(self.readahead, max(1, entry.window * 2))
+
+            for index in range(current + 1, current + 1 + entry.window):
+                if index not in entry.missing or index in entry.prefetching:
+                    continue
+                size = self._segment(entry, index)[0].size
+                if self.readahead_inflight + size > self.readahead_bytes:
+                    break
+                if self._prefetcher is None:
+                    self._prefetcher = ThreadPoolExecutor(max_workers=READAHEAD_WORKERS,
+                                                          thread_name_prefix="freyafs-readahead")
+                self.readahead_inflight += size
+                METRICS.inc("readahead_segments_total")
+                entry.prefetching[index] = self._prefetcher.submit(
+                    self._prefetch, entry, index, size)
+
+    def _prefetch(self, entry, index, size):
+        """Decrypts a segment ahead of the reader (in the read-ahead pool)."""
+        try:
+            # Not under entry.lock: reads and writes of the other segments go on
+            plaintext = self._decrypt(entry, index)
+        except Exception:
+            # The file changed under us: the reader will load it if needed
+            plaintext = None
+
+        with entry.lock:
+            # Written, truncated or loaded by a writer meanwhile: too late
+            if plaintext is not None and not entry.removed and index in entry.missing:
+                entry.content.fill(plaintext, index * entry.info.segment_size)
+                entry.missing.discard(index)
+
+            with self._lock:
+                self.readahead_inflight -= size
+                entry.prefetching.pop(index, None)
+
+    def _wait_prefetch(self, entry, offset, length):
+        """Waits for the segments of a range being decrypted ahead. Must not be
+        called with entry.lock held: the read-ahead needs it to finish."""
+        indices = self._segments_in(entry, offset, length)
+        if not indices:
+            return
+        with self._lock:
+            futures = [entry.prefetching[i] for i in indices if i in entry.prefetching]
+        if futures:
+            wait(futures)
+
+    def _spill_for(self, size, entry=None):
+        """Returns a Spill for the content of a file of size bytes if it must
+        not be kept in memory, None otherwise (the index lock must be held)."""
+        spill = self.spill_size is not None and size >= self.spill_size
+        if not spill and self.memory_bytes:
+            in_memory = self.memory_used - (entry.in_memory if entry is not None else 0)
+            spill = in_memory + size > self.memory_bytes
+        if not spill:
+            return None
+        METRICS.inc("spilled_files_total")
+        return Spill(CHUNK_SIZE, self.spill_dir)
+
+    def _account(self, entry):
+        """Updates the plaintext bytes of entry counted in memory_used (the
+        index lock must be held)."""
+        # Holes and segments not decrypted yet count too: they may be
+        size = 0
+        if entry.content.spill is None and self.files.get(entry.path) is entry:
+            size = len(entry.content)
+        self.memory_used += size - entry.in_memory
+        entry.in_memory = size
+
+    def _drop(self, path):
+        """Takes a file out of the cache (the index lock must be held)."""
+        entry = self.files.pop(path)
+        entry.removed = True
+        self._account(entry)
+
+    def _content(self, size, text=b''):
+        with self._lock:
+            spill = self._spill_for(size)
+        return FileByteContent(text, spill)
+
+    def _segment(self, entry, index):
+        """Returns the Segment of index and the folder holding it."""
+        segment = entry.streamed.get(index)
+        if segment is not None:
+            return segment, os.path.join(entry.path, STAGING)
+        return entry.info.segments[index], entry.path
+
+    def _decrypt(self, entry, index):
+        info = entry.info
+        segment, folder = self._segment(entry, index)
+        path = MixSlice.locate(MixSlice.segment_path(folder, index, segment.version))
+        iv = MixSlice.segment_iv(info.iv, index, segment.version)
+        plaintext = MixSlice.decrypt(path, info.key, iv, digest=segment.digest)
+        if segment.codec is not None:
+            plaintext = Compression.decompress(plaintext, segment.codec, segment.size)
+        METRICS.inc("bytes_decrypted_total", len(plaintext))
+        return plaintext
+
+    def _verify(self, path, info):
+        """Checks the fragments of every segment of a file against their
+        digest (those written before digests cannot be checked)."""
+        for index, segment in enumerate(info.segments):
+            if segment.digest is not None:
+                segment_path = MixSlice.segment_path(path, index, segment.version)
+                MixSlice.verify(MixSlice.locate(segment_path), info.key, segment.digest)
+
+    def _dirty_segments(self, entry, chunks):
+        """Maps dirty chunks of the content to the segments holding them."""
+        size = entry.info.segment_size
+        dirty = set()
+        for chunk in chunks:
+            first = chunk * CHUNK_SIZE // size
+            last = ((chunk + 1) * CHUNK_SIZE - 1) // size
+            dirty.update(range(first, last + 1))
+        return dirty
+
+    def _stream(self, entry, offset):
+        """Follows the writes of a file and, while they move forward, hands
+        every segment the writer went past to the background, to be mixed and
+        staged for the next flush (entry.lock must be held)."""
+        size = entry.info.segment_size
+        if offset < entry.stream_next * size:
+            # Back into a segment already handed over: not a sequential
+            # writer, the rest is mixed at flush
+            entry.stream_next = None
+            return
+
+        while entry.stream_next < offset // size:
+            index = entry.stream_next
+            entry.stream_next += 1
+            first, last = index * size // CHUNK_SIZE, (index + 1) * size // CHUNK_SIZE
+            chunks = entry.content.take_dirty(first, last)
+            if not chunks:
+                # Not written: it keeps its stored fragments
+                continue
+
+            while len(entry.streaming) >= self.stream:
+                # Bounds the plaintext held by a fast writer
+                wait([future for future, _ in entry.streaming.values()],
+                     return_when=FIRST_COMPLETED)
+                self._harvest(entry)
+            with self._lock:
+                if self._streamer is None:
+                    self._streamer = ThreadPoolExecutor(max_workers=STREAM_WORKERS,
+                                                        thread_name_prefix="freyafs-stream")
+            METRICS.inc("streamed_segments_total")
+            # A version of its own: the segment may still be written again,
+            # or truncated away, and mixed at flush with a new iv
+            entry.info.generation += 1
+            entry.streaming[index] = (self._streamer.submit(
+                self._stage, entry.path, entry.content, entry.info, index,
+                entry.info.generation, size), chunks)
+        self._harvest(entry)
+
+    def _segment_name(self, index, version):
+        name = MixSlice.SEGMENT_NAME % (index, version)
+        if self.packed:
+            name += MixSlice.PACK_SUFFIX
+        return name
+
+    def _stage(self, path, content, info, index, generation, length):
+        """Mixes length bytes of a segment, compressed first if that is worth
+        it, into the staging folder of a file. Returns its Segment."""
+        offset = index * info.segment_size
+        data, stored, codec = content.iter_chunks(offset, length), length, None
+        if self.compress is not None:
+            # Chunk by chunk: writers are not held back for the whole of it
+            compressed = Compression.compress(content.copy_chunks(offset, length),
+                                              length, self.compress)
+            if compressed is not None:
+                data, stored, codec = compressed, len(compressed), self.compress
+
+        name = self._segment_name(index, generation)
+        iv = MixSlice.segment_iv(info.iv, index, generation)
+        digest = MixSlice.encrypt(data, os.path.join(path, STAGING, name),
+                                  info.key, iv, size=stored)
+        METRICS.inc("bytes_encrypted_total", length)
+        return Segment(length, generation, digest, codec)
+
+    def _harvest(self, entry, block=False):
+        """Records the segments mixed in the background (all of them, waiting
+        for them, if block) and drops their plaintext (entry.lock held)."""
+        if block and entry.streaming:
+            wait([future for future, _ in entry.streaming.values()])
+
+        size = entry.info.segment_size
+        for index, (future, chunks) in list(entry.streaming.items()):
+            if not future.done():
+                continue
+            del entry.streaming[index]
+            try:
+                entry.streamed[index] = future.result()
+            except Exception as e:
+                # Mixed at flush instead
+                print(f"[!] Streaming of {entry.path} failed: {e}")
+                entry.content.mark_dirty(chunks)
+                entry.stream_next = None
+                continue
+
+            # Missing first: a reader that finds the chunks evicted loads them
+            entry.missing.add(index)
+            if not entry.content.evict(index * size // CHUNK_SIZE, (index + 1) * size // CHUNK_SIZE):
+                # Written again meanwhile: mixed again at flush
+                entry.missing.discard(index)
+
+    def _encrypt(self, entry):
+        """Writes the changed segments, or the SecretBox of a small file, of a
+        file (entry.lock must be held). Returns the paths it made obsolete."""
+        info = entry.info
+        self._harvest(entry, block=True)
+
+        stored = info.segments or []
+        if info.segments is None:
+            # Legacy single-MixSlice file: move it to the segmented layout
+            info.segment_size = self.segment_size
+        chunks = entry.content.take_dirty()
+        # A chunk may span segments smaller than itself: those not decrypted
+        # yet were not modified (writes load them first), and keep their
+        # fragments
+        dirty = self._dirty_segments(entry, chunks) - entry.missing
+        # Streamed segments were mixed after any truncation: only the writes
+        # since make them stale
+        streamed = {i: s for i, s in entry.streamed.items() if i not in dirty}
+        if entry.truncated is not None:
+            dirty.update(range(entry.truncated // info.segment_size, len(stored)))
+        info.generation += 1
+
+        try:
+            # New versions are written aside and renamed into place, so that
+            # a crash never leaves a half-written segment behind
+            staging = os.path.join(entry.path, STAGING)
+            size = len(entry.content)
+            segments = []
+            staged = []
+            # Segments never decrypted are not in content: only a file fully
+            # in memory can become a single SecretBox
+            small = 0 < size <= self.small_size and not entry.missing
+            if small:
+                # Padding to a macro block is not worth it: a single SecretBox
+                name = SmallFile.NAME % info.generation
+                data = entry.content.iter_chunks()
+                SmallFile.encrypt(data, os.path.join(staging, name), info.key, info.generation)
+                METRICS.inc("bytes_encrypted_total", size)
+                staged.append(name)
+            else:
+                # Only the segments that were written, resized or created are
+                # mixed again; the others keep their fragments and version
+                for index, offset in enumerate(range(0, size, info.segment_size)):
+                    length = min(info.segment_size, size - offset)
+                    if index in streamed and streamed[index].size == length:
+                        # Already mixed and staged by _stream()
+                        segments.append(streamed[index])
+                        staged.append(self._segment_name(index, streamed[index].version))
+                        continue
+                    if index < len(stored) and index not in dirty \
+                            and stored[index].size == length:
+                        segments.append(stored[index])
+                        continue
+
+                    segments.append(self._stage(entry.path, entry.content, info, index,
+                                                info.generation, length))
+                    staged.append(self._segment_name(index, info.generation))
+
+            if self.fsync and staged:
+                MixSlice.fsync([os.path.join(staging, name) for name in staged] + [staging])
+            for name in staged:
+                os.rename(os.path.join(staging, name), os.path.join(entry.path, name))
+            if staged or self.stream:
+                # Streamed segments no longer used are dropped with it
+                _remove(staging)
+            if self.fsync and staged:
+                MixSlice.fsync([entry.path])
+        except BaseException:
+            entry.content.mark_dirty(chunks)
+            raise
+
+        obsolete = self._collect(entry, stored, segments)
+        entry.truncated = None
+        entry.streamed = {}
+        if self.stream:
+            entry.stream_next = size // info.segment_size
+        info.segments = segments
+        info.small = info.generation if small else None
+        return obsolete
+
+    def _collect(self, entry, stored, segments):
+        """Records what a flush made obsolete as garbage, and returns it."""
+        obsolete = set()
+        if entry.info.segments is None:
+            obsolete.update(os.path.join(entry.path, name)
+                            for name in os.listdir(entry.path)
+                            if MixSlice.is_fragment(name) or name == MixSlice.LEGACY_PACK)
+        if entry.info.small is not None:
+            obsolete.add(SmallFile.path(entry.path, entry.info.small))
+        for index, old in enumerate(stored):
+            if index >= len(segments) or segments[index] is not old:
+                path = MixSlice.segment_path(entry.path, index, old.version)
+                obsolete.update((path, path + MixSlice.PACK_SUFFIX))
+
+        with self._lock:
+            self.garbage.update(obsolete)
+        return obsolete
+
+    def _sweep(self, entry):
+        """Removes what crashed flushes left behind in the folder of a file:
+        staged segments, and segments (or legacy fragments) the metadata does
+        not point to."""
+        info = entry.info
+        current = set()
+        if info.segments is not None:
+            for index, s in enumerate(info.segments):
+                path = MixSlice.segment_path(entry.path, index, s.version)
+                current.update((path, path + MixSlice.PACK_SUFFIX))
+        if info.small is not None:
+            current.add(SmallFile.path(entry.path, info.small))
+
+        with self._lock:
+            writing = entry.path in self.writing
+        names = os.listdir(entry.path)
+        for name in names:
+            full = os.path.join(entry.path, name)
+            if name == STAGING and writing:
+                # Being filled by the write-back of this file
+                continue
+            if name == STAGING or name.startswith(MixSlice.CONVERT_PREFIX):
+                _remove(full)
+            elif MixSlice.parse_segment(name) is not None or \
+                    SmallFile.parse(name) is not None or \
+                    (info.segments is not None and
+                     (MixSlice.is_fragment(name) or name == MixSlice.LEGACY_PACK)):
+                with self._lock:
+                    referenced = full in current or full in self.garbage
+                # A folder whose segment was also packed is only a leftover
+                if not referenced or name + MixSlice.PACK_SUFFIX in names:
+                    _remove(full)
+
+    def _mark_modified(self, entry, written=0):
+        """Records a change of entry (the index lock must be held)."""
+        entry.modified = True
+        entry.mtimes = int(time())
+        if self._flusher is None:
+            return
+
+        entry.dirty_bytes += written
+        self.dirty_bytes += written
+        if entry.path not in self.pending:
+            self.pending[entry.path] = monotonic() + self.writeback_delay
+            self._wakeup.notify()
+        elif self.dirty_bytes >= self.writeback_bytes:
+            self._wakeup.notify()
+
+    def _write_back(self, entry):
+        """Encrypts a cached file if it was modified."""
+        with entry.lock:
+            if entry.removed:
+                return
 
-    # ------------------------------------------------------ Methods
+            with self._lock:
+                self.pending.pop(entry.path, None)
+                self.writing.add(entry.path)
+                self.dirty_bytes -= entry.dirty_bytes
+                entry.dirty_bytes = 0
+                modified, entry.modified = entry.modified, False
+
+            try:
+                if modified:
+                    METRICS.inc("writebacks_total")
+                    try:
+                        obsolete = self._encrypt(entry)
+                        if self.persist is not None:
+                            self.persist(entry.info)
+                    except BaseException:
+                        # Encrypted again, or only persisted, by the next try
+                        entry.modified = True
+                        raise
+
+                    if self.persist is not None:
+                        # Also what an earlier try that failed to persist
+                        # made obsolete: the metadata no longer points to it
+                        prefix = os.path.join(entry.path, '')
+                        with self._lock:
+                            obsolete |= {p for p in self.garbage if p.startswith(prefix)}
+                        self.reclaim(obsolete)
+
+                # Writing the segments touches the folder: restore the file times last
+                os.utime(entry.path, (entry.atimes, entry.mtimes))
+                if self.written is not None:
+                    self.written(entry.path)
+                with self._lock:
+                    entry.failures = 0
+            finally:
+                with self._lock:
+                    self.writing.discard(entry.path)
+
+        with self._lock:
+            if not entry.opens and not entry.modified \
+                    and self.files.get(entry.path) is entry \
+                    and entry.path not in self.pending \
+                    and entry.path not in self.writing \
+                    and entry.path not in self.idle:
+                # Released while waiting for its write-back
+                self._retire(entry.path)
+
+    def _retire(self, path):
+        """Moves a clean file nobody has open to the LRU (index lock held)."""
+        if not self.cache_bytes:
+            self._drop(path)
+            return
+
+        self.idle[path] = self.files[path].content.memory_usage()
+        self.idle_bytes += self.idle[path]
+        while self.idle_bytes > self.cache_bytes:
+            evicted, size = self.idle.popitem(last=False)
+            self.idle_bytes -= size
+            METRICS.inc("cache_evictions_total")
+            self._drop(evicted)
+
+    def _revive(self, path):
+        """Takes a file out of the LRU (the index lock must be held)."""
+        self.idle_bytes -= self.idle.pop(path)
+
+    def _writeback_loop(self):
+        while True:
+            with self._lock:
+                while True:
+                    now = monotonic()
+                    urgent = self._closing or self.dirty_bytes >= self.writeback_bytes
+                    due = [self.files[path] for path, deadline in self.pending.items()
+                           if urgent or deadline <= now]
+                    if due or not self.pending and self._closing:
+                        break
+                    if not self.pending:
+                        self._wakeup.wait()
+                    else:
+                        self._wakeup.wait(min(self.pending.values()) - now)
+
+                if not due:
+                    return
+
+            for entry in due:
+                try:
+                    self._write_back(entry)
+                except Exception as e:
+                    # Keep the plaintext around and retry later, less and less
+                    # often (once closing, close() makes the last attempt)
+                    print(f"[!] Write-back of {entry.path} failed: {e!r}")
+                    with self._lock:
+                        entry.failures += 1
+                        if not self._closing and not entry.removed:
+                            delay = min(WRITEBACK_RETRY_MAX,
+                                        WRITEBACK_RETRY * 2 ** (entry.failures - 1))
+                            self.pending[entry.path] = monotonic() + delay
 
-    def open(self, path, key, iv, mtime):
-        with LOCK:
-            if path in self.files:
-                self.files[path].opens += 1
-                return
+    # ------------------------------------------------------ Methods
 
-            plaintext = FileByteContent(self._decrypt(path, key, iv))
-            self.files[path] = CacheEntry(path, plaintext, mtime)
+    def open(self, path, info, mtime):
+        while True:
+            with self._lock:
+                entry = self.files.get(path)
+                if entry is not None and path in self.idle:
+                    self._revive(path)
+                    # The folder of the file is stamped with mtimes on every
+                    # flush: if it changed since, the plaintext is stale
+                    if abs(entry.mtimes - mtime) >= 0.001:
+                        self._drop(path)
+                        entry = None
+
+                if entry is None:
+                    METRICS.inc("cache_misses_total", kind="open")
+                    entry = CacheEntry(path, FileByteContent(), info, mtime)
+                    # Other openers wait on this lock until the file is loaded
+                    entry.lock.acquire()
+                    self.files[path] = entry
+                    break
+
+                METRICS.inc("cache_hits_total", kind="open")
+                entry.opens += 1
+
+            with entry.lock:
+                if not entry.removed:
+                    return
+
+        try:
+            self._sweep(entry)
+            if info.segments is None:
+                plaintext = MixSlice.decrypt(MixSlice.locate_legacy(path), info.key, info.iv)
+                entry.content = self._content(len(plaintext), plaintext)
+                METRICS.inc("bytes_decrypted_total", len(entry.content))
+            elif info.small is not None:
+                small = SmallFile.path(path, info.small)
+                entry.content = FileByteContent(SmallFile.decrypt(small, info.key, info.small))
+                METRICS.inc("bytes_decrypted_total", len(entry.content))
+            else:
+                if self.verify:
+                    self._verify(path, info)
+                # Segments are only decrypted when a read or write reaches them
+                size = sum(s.size for s in info.segments)
+                entry.content = self._content(size)
+                entry.content.truncate(size)
+                entry.missing = set(range(len(info.segments)))
+                if self.stream:
+                    entry.stream_next = size // info.segment_size
+            with self._lock:
+                self._account(entry)
+        except BaseException:
+            with self._lock:
+                if self.files.get(path) is entry:
+                    self._drop(path)
+                entry.removed = True
+            raise
+        finally:
+            entry.lock.release()
+
+    def create(self, path, info):
+        os.makedirs(path, exist_ok=True)
+
+        with self._lock:
+            if path in self.idle:
+                # A new file with the same name: the cached one is gone
+                self._revive(path)
+                self._drop(path)
 
-    def create(self, path, key, iv):
-        with LOCK:
             if path in self.files:
                 self.files[path].opens += 1
                 return
 
             plaintext = FileByteContent(b'')
-            self.files[path] = CacheEntry(path, plaintext)
+            self.files[path] = CacheEntry(path, plaintext, info)
+            if self.stream:
+                self.files[path].stream_next = 0
+            self._mark_modified(self.files[path])
 
-        self.flush(path, key, iv)
+        self.flush(path)
 
     def read_bytes(self, path, offset, length):
-        with LOCK:
-            if path not in self.files:
-                return None
-        content = self.files[path].content
-        return content.read_bytes(offset, length)
+        entry = self._get(path)
+        if entry is None:
+            return None
+
+        self._wait_prefetch(entry, offset, length)
+        self._load(entry, offset, length)
+        self._read_ahead(entry, offset, length)
+        view = entry.content.read_view(offset, length)
+        while view is None:
+            # Streamed and evicted since it was loaded
+            self._load(entry, offset, length)
+            view = entry.content.read_view(offset, length)
+        return view
 
     def write_bytes(self, path, buf, offset):
-        with LOCK:
-            if path not in self.files:
-                return 0
-
-        content = self.files[path].content
-        bytes_written = content.write_bytes(buf, offset)
-        
-        self.files[path].modified = True
-        self.files[path].mtimes = int(time())
+        entry = self._get(path)
+        if entry is None:
+            return 0
+
+        with entry.lock:
+            size = len(entry.content)
+            if offset > size > 0:
+                # The hole grows the old last segment, which is mixed again
+                self._load(entry, size - 1, 1)
+            self._load(entry, offset, len(buf))
+            bytes_written = entry.content.write_bytes(buf, offset)
+
+            spill = None
+            with self._lock:
+                self._mark_modified(entry, bytes_written)
+                if entry.content.spill is None and offset + bytes_written > size:
+                    # Grown past what may stay in memory
+                    spill = self._spill_for(len(entry.content), entry)
+                self._account(entry)
+            if spill is not None:
+                entry.content.spill_to(spill)
+                with self._lock:
+                    self._account(entry)
+            if self.stream and entry.stream_next is not None:
+                self._stream(entry, offset)
 
         return bytes_written
 
     def truncate_bytes(self, path, length):
-        with LOCK:
-            if path not in self.files:
-                return
-
-        content = self.files[path].content
-        content.truncate(length)
-        
-        self.files[path].modified = True
-        self.files[path].mtimes = int(time())
+        entry = self._get(path)
+        if entry is None:
+            return
+
+        with entry.lock:
+            self._harvest(entry, block=True)
+
+            # The segments holding the old and the new end of file change
+            size = len(entry.content)
+            if length:
+                self._load(entry, min(length, size) - 1, 1)
+            self._load(entry, size - 1, 1)
+            entry.missing = {i for i in entry.missing
+                             if i * entry.info.segment_size < length}
+
+            # Streamed segments no longer whole are mixed again
+            segment_size = entry.info.segment_size
+            for index in [i for i in entry.streamed if (i + 1) * segment_size > length]:
+                del entry.streamed[index]
+            if entry.stream_next is not None:
+                entry.stream_next = min(entry.stream_next, length // segment_size)
+            if length < size and (entry.truncated is None or length < entry.truncated):
+                entry.truncated = length
+
+            entry.content.truncate(length)
+
+            with self._lock:
+                self._mark_modified(entry)
+                self._account(entry)
+
+    def flush(self, path, sync=False):
+        entry = self._get(path)
+        if entry is None:
+            return
+
+        if self._flusher is not None and not sync:
+            # Coalesced: the file is already queued if it was modified
+            return
+
+        self._write_back(entry)
 
-    def flush(self, path, key, iv):
-        with LOCK:
+    def release(self, path):
+        with self._lock:
             if path not in self.files:
                 return
 
-        file_already_exists = os.path.exists(path)
-        if file_already_exists:
-            os.utime(path, (self.files[path].atimes, self.files[path].mtimes))
-
-        with LOCK:
-            if not self.files[path].modified:
+            entry = self.files[path]
+            entry.opens -= 1
+            if entry.opens or path in self.pending or path in self.writing:
+                # Otherwise retired once its write-back is over
                 return
-
-            self.files[path].modified = False
-            self._encrypt(path, key, iv)
-        
-        if not file_already_exists:
-            os.utime(path, (self.files[path].atimes, self.files[path].mtimes))
-
-    def release(self, path):
-        with LOCK:
-            if path not in self.files:
+            if entry.modified:
+                # Its flush failed: it stays out of the LRU, which may drop
+                # it, until it is written (by the write-back or by close())
+                if self._flusher is not None:
+                    self.pending[path] = monotonic() + self.writeback_delay
+                    self._wakeup.notify()
                 return
-
-            self.files[path].opens -= 1
-            if not self.files[path].opens:
-                del self.files[path]
+            self._retire(path)
+
+    def discard(self, path):
+        """Forgets a file that was removed, without writing it back."""
+        prefix = os.path.join(path, '')
+        with self._lock:
+            self.garbage = {g for g in self.garbage if not g.startswith(prefix)}
+            self.pending.pop(path, None)
+            if path in self.idle:
+                self._revive(path)
+            entry = self.files.pop(path, None)
+            if entry is None:
+                return
+            self._account(entry)
+            self.dirty_bytes -= entry.dirty_bytes
+
+        # Waits for an encryption in progress, which must not outlive unlink
+        with entry.lock:
+            self._harvest(entry, block=True)
+            entry.removed = True
+
+    def reclaim(self, paths=None):
+        """Deletes the garbage of past flushes (or only some paths of it): call
+        it only once the metadata pointing to the new segments is persisted."""
+        with self._lock:
+            if paths is None:
+                garbage, self.garbage = self.garbage, set()
+            else:
+                garbage = paths & self.garbage
+                self.garbage -= garbage
+
+        for path in garbage:
+            _remove(path)
+
+    def close(self):
+        """Stops the read-ahead, writes back every modified file and stops
+        the write-back and streaming threads. Returns the paths of the files
+        that could not be written back."""
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+            prefetcher = self._prefetcher
+
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=True, cancel_futures=True)
+        if self._flusher is not None:
+            self._flusher.join()
+
+        # Whatever the write-back thread failed to write, or no flush wrote
+        with self._lock:
+            left = [entry for entry in self.files.values() if entry.modified]
+        failed = []
+        for entry in left:
+            try:
+                self._write_back(entry)
+            except Exception as e:
+                print(f"[!] Write-back of {entry.path} failed: {e!r}")
+                failed.append(entry.path)
+
+        if self._streamer is not None:
+            self._streamer.shutdown(wait=True)
+        return failed
 
     def get_size(self, path):
-        with LOCK:
-            if path not in self.files:
-                return 0
+        entry = self._get(path)
+        if entry is None:
+            return 0
 
-        return len(self.files[path].content)
+        return len(entry.content)
 
     def rename(self, old, new):
-        with LOCK:
-            if old not in self.files:
-                return
-
-            self.files[new] = self.files[old]
-            del self.files[old]
+        """Renames a file or a folder on disk, together with its cached files.
+
+        The files being moved are locked, so that no encryption targets a path
+        that was just moved away.
+        """
+        prefix = os.path.join(old, '')
+        locked = []
+        try:
+            while True:
+                with self._lock:
+                    moved = [path for path in self.files
+                             if path == old or path.startswith(prefix)]
+                    waiting = [self.files[path] for path in moved
+                               if self.files[path] not in locked]
+                    if not waiting:
+                        os.rename(old, new)
+                        # Garbage of a file replaced by the rename is gone too
+                        target = os.path.join(new, '')
+                        self.garbage = {new + path[len(old):]
+                                        if path.startswith(prefix) else path
+                                        for path in self.garbage
+                                        if not path.startswith(target)}
+                        for path in moved:
+                            to = new + path[len(old):]
+                            self.files[to] = self.files.pop(path)
+                            self.files[to].path = to
+                            if path in self.pending:
+                                self.pending[to] = self.pending.pop(path)
+                            if path in self.idle:
+                                self.idle[to] = self.idle.pop(path)
+                        return
+
+                for entry in sorted(waiting, key=id):
+                    entry.lock.acquire()
+                    locked.append(entry)
+                    # Streamed segments are staged under the old path
+                    self._harvest(entry, block=True)
+        finally:
+            for entry in locked:
+                entry.lock.release()
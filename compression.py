@@ -0,0 +1,98 @@
+import errno as _errno
+import lzma as _lzma
+import zlib as _zlib
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+from metrics import METRICS as _metrics
+
+_ERRORS = (_zlib.error, _lzma.LZMAError) + ((_zstd.ZstdError,) if _zstd is not None else ())
+
+
+class Compression:
+    """Optional compression of the plaintext of a segment before it is mixed.
+
+    Every segment is compressed on its own, so that a read still decrypts only
+    the segments it touches, and records its codec (None: stored as is) next
+    to its uncompressed size. Data that does not compress, like images or
+    archives, is detected on its first chunk and stored as is.
+    """
+
+    CODECS = ("zlib", "lzma", "zstd")
+
+    # A segment is only stored compressed if that saves at least this much
+    MIN_SAVING = 0.1
+
+    # Bytes of a segment tried with a fast zlib pass before compressing it all
+    SAMPLE_SIZE = 128 * 1024
+
+    @staticmethod
+    def available(codec):
+        """Returns whether codec can be used (zstd needs zstandard)."""
+        return codec in Compression.CODECS and (codec != "zstd" or _zstd is not None)
+
+    @staticmethod
+    def _compressor(codec):
+        if codec == "zlib":
+            return _zlib.compressobj(6)
+        if codec == "lzma":
+            return _lzma.LZMACompressor(preset=1)
+        return _zstd.ZstdCompressor(level=3).compressobj()
+
+    @staticmethod
+    def _worth(compressed, size):
+        return compressed <= size * (1 - Compression.MIN_SAVING)
+
+    @staticmethod
+    def compress(data, size, codec):
+        """Compresses size bytes of data (bytes-like or iterable of chunks)
+        with codec. Returns the compressed bytes, or None if data is better
+        stored as is."""
+        chunks = iter((data,) if isinstance(data, (bytes, bytearray, memoryview)) else data)
+        try:
+            with _metrics.timer("compression_seconds", op="compress"):
+                compressor = Compression._compressor(codec)
+                parts = []
+                sampled = 0
+                for chunk in chunks:
+                    if len(chunk) and sampled < Compression.SAMPLE_SIZE:
+                        sample = memoryview(chunk)[:Compression.SAMPLE_SIZE - sampled]
+                        sampled += len(sample)
+                        if not Compression._worth(len(_zlib.compress(sample, 1)), len(sample)):
+                            _metrics.inc("compression_bypassed_total")
+                            return None
+                    parts.append(compressor.compress(chunk))
+                parts.append(compressor.flush())
+                compressed = b''.join(parts)
+        finally:
+            # Releases the content the chunks come from
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+        if not Compression._worth(len(compressed), size):
+            _metrics.inc("compression_bypassed_total")
+            return None
+        _metrics.inc("compression_saved_bytes_total", size - len(compressed))
+        return compressed
+
+    @staticmethod
+    def decompress(data, codec, size):
+        """Returns the size bytes compressed with codec in data."""
+        with _metrics.timer("compression_seconds", op="decompress"):
+            try:
+                if codec == "zlib":
+                    plaintext = _zlib.decompress(data, bufsize=size)
+                elif codec == "lzma":
+                    plaintext = _lzma.decompress(data)
+                elif codec == "zstd" and _zstd is not None:
+                    plaintext = _zstd.ZstdDecompressor().decompress(data, max_output_size=size)
+                else:
+                    raise OSError(_errno.EIO, f"unknown compression codec {codec}")
+            except _ERRORS as e:
+                raise OSError(_errno.EIO, f"corrupted compressed segment: {e}")
+        if len(plaintext) != size:
+            raise OSError(_errno.EIO, "corrupted compressed segment: wrong size")
+        return plaintext
@@ -1,10 +1,52 @@
 import threading
 
+# Size of the pages the plaintext is split into: the size of the read requests
+# of FUSE, so that an aligned read is served from a single page
+CHUNK_SIZE = 128 * 1024
+
+_ZEROS = bytes(CHUNK_SIZE)
+
+
 class FileByteContent:
-    def __init__(self, text):
-        self._text = text
+    """Mutable plaintext of an open file.
+
+    The content is kept as a list of fixed-size chunks (bytearray pages) so
+    that a write only touches the pages it covers. A chunk set to None is a
+    hole and reads as zeros. Every chunk modified since the last call to
+    take_dirty() is recorded in a dirty bitmap.
+
+    Chunks are never resized in place, because read_view() hands out views of
+    them: a chunk that must grow is replaced by a full-size copy, and the bytes
+    of a chunk past the end of the file are kept zeroed.
+
+    With a Spill, chunks are instead full-size pages of a memory-mapped file
+    (see spill.py), so that the content of a large file is not Python heap.
+
+    Chunks already persisted may be evicted: they are dropped, and read_view()
+    refuses them until they are filled again.
+    """
+
+    def __init__(self, text=b'', spill=None):
+        self._chunks = []
+        self._size = 0
+        self._dirty = set()
         self._cond = threading.Condition(threading.Lock())
         self._readers = 0
+        # Chunk index -> page of the spill, for the chunks that live there
+        self.spill = spill
+        self._pages = {}
+        self._evicted = set()
+
+        view = memoryview(text)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            piece = view[offset:offset + CHUNK_SIZE]
+            if spill is None:
+                self._chunks.append(bytearray(piece))
+            else:
+                chunk = self._new_chunk(len(self._chunks))
+                chunk[:len(piece)] = piece
+                self._chunks.append(chunk)
+        self._size = len(view)
 
     def _r_acquire(self):
         self._cond.acquire()
@@ -30,33 +72,217 @@ class FileByteContent:
     def _w_release(self):
         self._cond.release()
 
+    # ------------------------------------------------------ Helpers
+
+    def _new_chunk(self, index):
+        """Returns a zeroed full-size chunk for index (write lock held)."""
+        if self.spill is None:
+            return bytearray(CHUNK_SIZE)
+        page, chunk = self.spill.allocate()
+        self._pages[index] = page
+        return chunk
+
+    def _drop_chunks(self, keep):
+        """Forgets the chunks from keep on (write lock held)."""
+        for index in [i for i in self._pages if i >= keep]:
+            self.spill.free(self._pages.pop(index))
+        del self._chunks[keep:]
+        self._evicted = {i for i in self._evicted if i < keep}
+
+    def _views(self, offset, length):
+        """Yields the pieces covering [offset, offset + length)."""
+        end = min(offset + length, self._size)
+        while offset < end:
+            index, start = divmod(offset, CHUNK_SIZE)
+            count = min(CHUNK_SIZE - start, end - offset)
+            chunk = self._chunks[index] if index < len(self._chunks) else None
+            if chunk is None or start >= len(chunk):
+                yield memoryview(_ZEROS)[:count]
+            elif start + count > len(chunk):
+                # The chunk is shorter than the file: the tail reads as zeros
+                yield memoryview(chunk)[start:]
+                yield memoryview(_ZEROS)[:start + count - len(chunk)]
+            else:
+                yield memoryview(chunk)[start:start + count]
+            offset += count
+
+    def _write(self, view, offset, dirty):
+        bytes_written = len(view)
+        end = offset + bytes_written
+
+        last = (end - 1) // CHUNK_SIZE if bytes_written else -1
+        if last >= len(self._chunks):
+            self._chunks.extend([None] * (last + 1 - len(self._chunks)))
+
+        position = offset
+        while position < end:
+            index, start = divmod(position, CHUNK_SIZE)
+            count = min(CHUNK_SIZE - start, end - position)
+            chunk = self._chunks[index]
+            if chunk is None:
+                chunk = self._chunks[index] = self._new_chunk(index)
+                self._evicted.discard(index)
+            elif len(chunk) < start + count:
+                grown = self._new_chunk(index)
+                grown[:len(chunk)] = chunk
+                chunk = self._chunks[index] = grown
+            chunk[start:start + count] = view[position - offset:position - offset + count]
+            if dirty:
+                self._dirty.add(index)
+            position += count
+
+        self._size = max(self._size, end)
+        return bytes_written
+
+    # ------------------------------------------------------ Methods
+
     def __len__(self):
         self._r_acquire()
-        length = len(self._text)
+        length = self._size
         self._r_release()
         return length
 
-    def read_all(self):
+    def memory_usage(self):
+        """Returns the number of plaintext bytes held in memory."""
         self._r_acquire()
-        text = self._text
+        usage = sum(len(chunk) for chunk in self._chunks if chunk is not None)
         self._r_release()
-        return text
+        return usage
+
+    def read_all(self):
+        return b''.join(self.iter_chunks())
+
+    def iter_chunks(self, offset=0, length=None):
+        """Yields the content (or a range of it) as a sequence of memoryviews.
+
+        The read lock is held until the iteration is over, so the consumer
+        must not keep references to the yielded views.
+        """
+        self._r_acquire()
+        try:
+            if length is None:
+                length = self._size - offset
+            yield from self._views(offset, length)
+        finally:
+            self._r_release()
+
+    def copy_chunks(self, offset=0, length=None):
+        """Like iter_chunks, but yields copies, and holds the read lock only
+        while copying each of them: writers may go on while the consumer works
+        on the content (e.g. compresses it) for a long time."""
+        if length is None:
+            length = len(self) - offset
+        end = offset + length
+        while offset < end:
+            count = min(CHUNK_SIZE - offset % CHUNK_SIZE, end - offset)
+            yield self.read_bytes(offset, count)
+            offset += count
 
     def read_bytes(self, offset, length):
         self._r_acquire()
-        text = self._text[offset:offset + length]
-        self._r_release()
+        try:
+            text = b''.join(self._views(offset, length))
+        finally:
+            self._r_release()
         return text
 
+    def read_view(self, offset, length):
+        """Like read_bytes, but a range within a single chunk is returned as a
+        writable memoryview of it, without copying. The view is live: it sees
+        later writes, so it must be consumed right away. Returns None if the
+        range overlaps evicted chunks."""
+        self._r_acquire()
+        try:
+            if self._evicted and length > 0:
+                last = (min(offset + length, self._size) - 1) // CHUNK_SIZE
+                if any(i in self._evicted for i in range(offset // CHUNK_SIZE, last + 1)):
+                    return None
+            views = list(self._views(offset, length))
+            if len(views) == 1 and not views[0].readonly:
+                return views[0]
+            return b''.join(views)
+        finally:
+            self._r_release()
+
     def write_bytes(self, buf, offset):
         self._w_acquire()
-        bytes_written = len(buf)
-        new_text = self._text[:offset] + buf + self._text[offset+bytes_written:]
-        self._text = new_text
-        self._w_release()
+        try:
+            bytes_written = self._write(memoryview(buf), offset, dirty=True)
+        finally:
+            self._w_release()
         return bytes_written
 
+    def fill(self, buf, offset):
+        """Stores data that is already persisted, without marking it dirty."""
+        self._w_acquire()
+        try:
+            self._write(memoryview(buf), offset, dirty=False)
+        finally:
+            self._w_release()
+
     def truncate(self, length):
         self._w_acquire()
-        self._text = self._text[:length]
+        try:
+            if length < self._size:
+                index, start = divmod(length, CHUNK_SIZE)
+                keep = index + 1 if start else index
+                self._drop_chunks(keep)
+                self._dirty = {i for i in self._dirty if i < keep}
+                if start and index < len(self._chunks):
+                    chunk = self._chunks[index]
+                    if chunk is not None and len(chunk) > start:
+                        chunk[start:] = bytes(len(chunk) - start)
+                    self._dirty.add(index)
+            elif length > self._size and self._size:
+                # The new bytes are zeros: they live in the (shorter) last chunk
+                self._dirty.add((self._size - 1) // CHUNK_SIZE)
+            self._size = length
+        finally:
+            self._w_release()
+
+    def spill_to(self, spill):
+        """Moves the content into the pages of a spill."""
+        self._w_acquire()
+        try:
+            self.spill = spill
+            for index, chunk in enumerate(self._chunks):
+                if chunk is not None:
+                    page = self._new_chunk(index)
+                    page[:len(chunk)] = chunk
+                    self._chunks[index] = page
+        finally:
+            self._w_release()
+
+    def mark_dirty(self, chunks):
+        """Marks chunks dirty again, e.g. after a failed encryption."""
+        self._w_acquire()
+        self._dirty.update(chunks)
         self._w_release()
+
+    def take_dirty(self, first=0, last=None):
+        """Returns the sorted indices of the dirty chunks (only those from
+        first to last - 1, if given) and marks them clean."""
+        self._w_acquire()
+        if last is None:
+            dirty = sorted(i for i in self._dirty if i >= first)
+        else:
+            dirty = sorted(i for i in self._dirty if first <= i < last)
+        self._dirty.difference_update(dirty)
+        self._w_release()
+        return dirty
+
+    def evict(self, first, last):
+        """Drops the chunks from first to last - 1, already persisted, unless
+        some were written since they were taken clean. Returns whether it did."""
+        self._w_acquire()
+        try:
+            if any(first <= i < last for i in self._dirty):
+                return False
+            for index in range(first, min(last, len(self._chunks))):
+                if index in self._pages:
+                    self.spill.free(self._pages.pop(index))
+                self._chunks[index] = None
+                self._evicted.add(index)
+            return True
+        finally:
+            self._w_release()
@@ -1,31 +1,85 @@
+import ctypes
 import os
 import errno
 import stat
 import shutil
+import time
 
 from fuse import FuseOSError, Operations
 
-from cache import Cache
+from attrcache import AttrCache
+from cache import Cache, READAHEAD, READAHEAD_BYTES, SEGMENT_SIZE, SMALL_SIZE, WRITEBACK_BYTES
 from metadata import Metadata
+from metrics import METRICS
+
+# Read-only virtual file, in the root of the mountpoint, with the metrics in
+# the Prometheus text format
+METRICS_FILE = "/.freyafs.metrics"
+
+# Names, in the root of the volume, of the files unlinked while still open
+# (see AsyncFreyaFS): removed at their last release
+UNLINKED_PREFIX = ".freyafs-unlinked-"
 
 
 def is_metadata(path=''):
-    return path == ".freyafs"
+    return path in (".freyafs", ".freyafs.db", ".freyafs.db-wal", ".freyafs.db-shm",
+                    ".freyafs-import", METRICS_FILE.lstrip("/")) or \
+        path.startswith(UNLINKED_PREFIX)
 
 
 class FreyaFS(Operations):
-    def __init__(self, root, mountpoint):
+    def __init__(self, root, mountpoint, segment_size=SEGMENT_SIZE,
+                 writeback_delay=None, writeback_bytes=WRITEBACK_BYTES,
+                 cache_bytes=0, fsync=False, packed=False,
+                 small_size=SMALL_SIZE, readahead=READAHEAD,
+                 readahead_bytes=READAHEAD_BYTES, spill_size=None, memory_bytes=0,
+                 spill_dir=None, password=None, kdf_opslimit=None, kdf_memlimit=None,
+                 background_unlock=False, verify_open=False, stream=0,
+                 compress=None):
         self.root = root
 
         # Retrieve FreyaFS metadata
-        self.metadata = Metadata(os.path.join(root, ".freyafs"))
+        self.metadata = Metadata(os.path.join(root, ".freyafs"), password,
+                                 kdf_opslimit, kdf_memlimit, background_unlock)
+        # Attributes and listings already computed
+        self.attrs = AttrCache()
         # Keep track of open files
-        self.cache = Cache()
+        self.cache = Cache(segment_size, writeback_delay, writeback_bytes,
+                           cache_bytes, fsync, packed, small_size,
+                           persist=self.metadata.save, readahead=readahead,
+                           readahead_bytes=readahead_bytes, spill_size=spill_size,
+                           memory_bytes=memory_bytes, spill_dir=spill_dir,
+                           verify=verify_open, stream=stream,
+                           compress=compress, written=self._written)
+        # Metrics as of the last getattr of METRICS_FILE: reads return this
+        # text, so that they agree with the size the kernel was told
+        self._metrics_text = b""
 
         print(f"[*] FreyaFS mounted")
         print(f"Now, through the FreyaFS mountpoint ({mountpoint}), you can use a Mix&Slice encrypted filesystem seemlessly.")
         print(f"FreyaFS will persist your encrypted data at {root}.")
 
+    def __call__(self, op, path, *args):
+        if path == METRICS_FILE:
+            return self._control(op, *args)
+
+        with METRICS.timer("operation_seconds", op=op):
+            try:
+                result = super().__call__(op, path, *args)
+                if op == 'readdir':
+                    # A generator: time the listing, not its creation
+                    result = list(result)
+                elif op == 'read' and isinstance(result, memoryview):
+                    # fusepy copies the data to the kernel with ctypes.memmove,
+                    # which takes a ctypes array but not a memoryview: wrap the
+                    # cached plaintext instead of copying it into bytes
+                    result = (ctypes.c_char * len(result)).from_buffer(result)
+                return result
+            except OSError as e:
+                METRICS.inc("operation_errors_total", op=op,
+                            errno=errno.errorcode.get(e.errno, e.errno))
+                raise
+
     # --------------------------------------------------------------------- Helpers
 
     def _full_path(self, partial):
@@ -34,12 +88,72 @@ class FreyaFS(Operations):
         return path
 
     def _is_file(self, path):
-        if not os.path.exists(self._full_path(path)):
+        try:
+            attr = self.getattr(path)
+        except FileNotFoundError:
             return False
 
-        attr = self.getattr(path)
         return attr['st_mode'] & stat.S_IFREG == stat.S_IFREG
 
+    def _attributes(self, st, info):
+        """Attributes of a path from its lstat and, for files, its metadata."""
+        if info is None:
+            return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                                                            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+
+        return {
+            'st_mode': stat.S_IFREG | (st.st_mode & ~stat.S_IFDIR),
+            'st_nlink': 1,
+            'st_atime': st.st_atime,
+            'st_ctime': st.st_ctime,
+            'st_gid': st.st_gid,
+            'st_mtime': st.st_mtime,
+            'st_size': info.size,
+            'st_uid': st.st_uid
+        }
+
+    def _control(self, op, *args):
+        """Serves METRICS_FILE, which only supports reading."""
+        if op == 'getattr':
+            self._metrics_text = METRICS.render().encode("ascii")
+            st = os.lstat(self.root)
+            now = time.time()
+            return {
+                'st_mode': stat.S_IFREG | 0o444,
+                'st_nlink': 1,
+                'st_atime': now,
+                'st_ctime': now,
+                'st_mtime': now,
+                'st_gid': st.st_gid,
+                'st_size': len(self._metrics_text),
+                'st_uid': st.st_uid
+            }
+        if op == 'open':
+            if args[0] & (os.O_WRONLY | os.O_RDWR):
+                raise FuseOSError(errno.EACCES)
+            return 0
+        if op == 'read':
+            length, offset = args[0], args[1]
+            return self._metrics_text[offset:offset + length]
+        if op == 'access':
+            if args[0] & os.W_OK:
+                raise FuseOSError(errno.EACCES)
+            return 0
+        if op in ('flush', 'release', 'utimens'):
+            return 0
+        raise FuseOSError(errno.EPERM)
+
+    def _written(self, full_path):
+        # A write-back stamped the times of a file: a getattr that read them
+        # before must not cache them once the file leaves the cache
+        self.attrs.invalidate("/" + os.path.relpath(full_path, self.root))
+
+    def _remember(self, path, attrs, epoch):
+        # Open files change size and times without going through FreyaFS
+        # methods that invalidate, so their attributes are never kept
+        if self._full_path(path) not in self.cache:
+            self.attrs.put(path, attrs, epoch)
+
     # --------------------------------------------------------------------- Filesystem methods
 
     def access(self, path, mode):
@@ -49,49 +163,63 @@ class FreyaFS(Operations):
 
     def chmod(self, path, mode):
         full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        # Attributes are forgotten once the change is on disk (or failed):
+        # a getattr in between would otherwise cache them as they were
+        try:
+            return os.chmod(full_path, mode)
+        finally:
+            self.attrs.invalidate(path)
 
     def chown(self, path, uid, gid):
         full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        try:
+            return os.chown(full_path, uid, gid)
+        finally:
+            self.attrs.invalidate(path)
 
     # Attributi di path (file o cartella)
     def getattr(self, path, fh=None):
+        attrs = self.attrs.get(path)
+        if attrs is not None:
+            return attrs
+
         full_path = self._full_path(path)
+        epoch = self.attrs.epoch()
 
         st = os.lstat(full_path)
-
-        if full_path not in self.metadata:
-            return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-
-        try:
-            return {
-                'st_mode': stat.S_IFREG | (st.st_mode & ~stat.S_IFDIR),
-                'st_nlink': 1,
-                'st_atime': st.st_atime,
-                'st_ctime': st.st_ctime,
-                'st_gid': st.st_gid,
-                'st_mtime': st.st_mtime,
-                'st_size': self.metadata[full_path].size,
-                'st_uid': st.st_uid
-            }
-        except:
-            return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        attrs = self._attributes(st, self.metadata.get(path))
+        self._remember(path, attrs, epoch)
+        return attrs
 
     def readdir(self, path, fh):
         full_path = self._full_path(path)
-        dirents = ['.', '..']
-
-        if os.path.isdir(full_path):
-            real_stuff = os.listdir(full_path)
-            virtual_stuff = [
-                x for x in real_stuff if not is_metadata(x)]
-            dirents.extend(virtual_stuff)
-
-        for r in dirents:
-            yield r
+        yield '.'
+        yield '..'
+
+        epoch = self.attrs.epoch()
+        names = self.attrs.get_listing(path)
+        if names is None:
+            if not os.path.isdir(full_path):
+                return
+            names = [x for x in os.listdir(full_path) if not is_metadata(x)]
+            self.attrs.put_listing(path, names, epoch)
+
+        # Attributes are returned with the names, so that the kernel does not
+        # need a getattr for each of them
+        files = None
+        for name in names:
+            child = os.path.join(path, name)
+            attrs = self.attrs.get(child)
+            if attrs is None:
+                if files is None:
+                    files = self.metadata.children(path)
+                try:
+                    st = os.lstat(os.path.join(full_path, name))
+                except FileNotFoundError:
+                    continue
+                attrs = self._attributes(st, files.get(name))
+                self._remember(child, attrs, epoch)
+            yield name, attrs, 0
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -102,13 +230,23 @@ class FreyaFS(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        return os.mknod(self._full_path(path), mode, dev)
+        try:
+            return os.mknod(self._full_path(path), mode, dev)
+        finally:
+            self.attrs.invalidate(path)
 
     def rmdir(self, path):
-        os.rmdir(self._full_path(path))
+        try:
+            os.rmdir(self._full_path(path))
+            self.metadata.remove(path)
+        finally:
+            self.attrs.invalidate(path)
 
     def mkdir(self, path, mode):
-        os.mkdir(self._full_path(path), mode)
+        try:
+            os.mkdir(self._full_path(path), mode)
+        finally:
+            self.attrs.invalidate(path)
 
     def statfs(self, path):
         full_path = self._full_path(path)
@@ -119,67 +257,85 @@ class FreyaFS(Operations):
 
     def unlink(self, path):
         full_path = self._full_path(path)
-        shutil.rmtree(full_path)
-        self.metadata.remove(full_path)
-        return
+        try:
+            self.cache.discard(full_path)
+            shutil.rmtree(full_path)
+            self.metadata.remove(path)
+        finally:
+            self.attrs.invalidate(path)
 
     def symlink(self, name, target):
-        return os.symlink(name, self._full_path(target))
+        try:
+            return os.symlink(name, self._full_path(target))
+        finally:
+            self.attrs.invalidate(target)
 
     def rename(self, old, new):
         full_old_path = self._full_path(old)
         full_new_path = self._full_path(new)
 
-        if self._is_file(old):
-            # Rinomino un file
-            if self._is_file(new):
-                self.unlink(new)
-
-            os.rename(full_old_path, full_new_path)
+        if self._is_file(old) and self._is_file(new):
+            # Rinomino un file sopra un altro
+            self.unlink(new)
 
-            if full_old_path in self.cache:
-                self.cache.rename(full_old_path, full_new_path)
-            self.metadata.rename(full_old_path, full_new_path)
-        else:
-            # Rinomino una cartella
-            os.rename(full_old_path, full_new_path)
-            self.metadata.renamedir(full_old_path, full_new_path)
+        # Files and folders are moved alike: a folder moves everything inside
+        try:
+            self.cache.rename(full_old_path, full_new_path)
+            self.metadata.rename(old, new)
+        finally:
+            self.attrs.invalidate_tree(old)
+            self.attrs.invalidate_tree(new)
 
     def link(self, target, name):
-        return os.link(self._full_path(target), self._full_path(name))
+        try:
+            return os.link(self._full_path(target), self._full_path(name))
+        finally:
+            self.attrs.invalidate(target, name)
 
     def utimens(self, path, times=None):
-        os.utime(self._full_path(path), times)
+        try:
+            os.utime(self._full_path(path), times)
+        finally:
+            self.attrs.invalidate(path)
 
     # --------------------------------------------------------------------- File methods
 
     def open(self, path, flags):
         full_path = self._full_path(path)
-        info = self.metadata[full_path]
-        attr = self.getattr(path)
-        mtime = attr['st_mtime']
-        self.cache.open(full_path, info.key, info.iv, mtime)
+        info = self.metadata[path]
+        # While open, the attributes of the file change with every write
+        self.attrs.forget(path)
+        # Fresh from the disk: a cached plaintext is only valid if it matches
+        mtime = os.lstat(full_path).st_mtime
+        self.cache.open(full_path, info, mtime)
         return 0
 
     def create(self, path, mode, fi=None):
         full_path = self._full_path(path)
-        key, iv = self.metadata.add(full_path)
-        self.cache.create(full_path, key, iv)
+        try:
+            info = self.metadata.add(path, self.cache.segment_size)
+            self.cache.create(full_path, info)
+        finally:
+            self.attrs.invalidate(path)
         return 0
 
     def read(self, path, length, offset, fh):
         full_path = self._full_path(path)
         if full_path in self.cache:
-            return self.cache.read_bytes(full_path, offset, length)
+            data = self.cache.read_bytes(full_path, offset, length)
+        else:
+            os.lseek(fh, offset, os.SEEK_SET)
+            data = os.read(fh, length)
 
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        METRICS.inc("bytes_served_total", len(data))
+        return data
 
     def write(self, path, buf, offset, fh):
         full_path = self._full_path(path)
         if full_path in self.cache:
             bytes_written = self.cache.write_bytes(full_path, buf, offset)
-            self.metadata.update(full_path, self.cache.get_size(full_path))
+            self.metadata.update(path, self.cache.get_size(full_path))
+            METRICS.inc("bytes_written_total", bytes_written)
             return bytes_written
 
         os.lseek(fh, offset, os.SEEK_SET)
@@ -187,19 +343,21 @@ class FreyaFS(Operations):
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
-        if full_path in self.cache:
-            self.cache.truncate_bytes(full_path, length)
-            self.metadata.update(full_path, length)
-            return
+        try:
+            if full_path in self.cache:
+                self.cache.truncate_bytes(full_path, length)
+                self.metadata.update(path, length)
+                return
 
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+            with open(full_path, 'r+') as f:
+                f.truncate(length)
+        finally:
+            self.attrs.invalidate(path)
 
     def flush(self, path, fh):
         full_path = self._full_path(path)
         if full_path in self.cache:
-            info = self.metadata[full_path]
-            self.cache.flush(full_path, info.key, info.iv)
+            self.cache.flush(full_path)
             return 0
 
         return os.fsync(fh)
@@ -213,4 +371,10 @@ class FreyaFS(Operations):
         return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
-        return self.flush(path, fh)
+        full_path = self._full_path(path)
+        if full_path in self.cache:
+            # Bypasses the write-back queue: the data is on disk when we return
+            self.cache.flush(full_path, sync=True)
+            return 0
+
+        return os.fsync(fh)
@@ -1,7 +1,22 @@
+import multiprocessing
+import sys
 from argparse import ArgumentParser
-from fuse import FUSE
 
-from freyafs import FreyaFS
+# The crypto processes of a bundled binary are the binary itself
+multiprocessing.freeze_support()
+
+if __name__ == '__main__' and sys.argv[1:2] in (['import'], ['export'], ['scrub']):
+    # Offline bulk commands (see bulktool.py): no FUSE needed
+    import bulktool
+    sys.exit(bulktool.main())
+
+from fuse import FUSE  # noqa: E402
+
+from freyafs import FreyaFS  # noqa: E402
+from compression import Compression  # noqa: E402
+from metadata import read_password  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from mixslice import MixSlice  # noqa: E402
 
 parser = ArgumentParser(
     description="Freya File System - a Mix&Slice virtual file system"
@@ -17,20 +32,227 @@ parser.add_argument('-t', '--multithread',
                     help='run in multi-threaded mode',
                     action='store_true',
                     default=False)
+parser.add_argument('--async',
+                    dest='async_frontend',
+                    help='serve requests from an asyncio event loop on pyfuse3 (libfuse 3) instead of fusepy, running them in bounded thread pools (needs pyfuse3)',
+                    action='store_true',
+                    default=False)
+parser.add_argument('--async-workers',
+                    metavar='N',
+                    help='with --async, threads running the operations that read or write files (default: 32)',
+                    type=int,
+                    default=32)
+parser.add_argument('--segment-size',
+                    metavar='MIB',
+                    help='size in MiB of the independently mixed segments of new files (default: 16)',
+                    type=int,
+                    default=16)
+parser.add_argument('--writeback',
+                    metavar='SECONDS',
+                    help='defer the encryption of closed files by SECONDS and coalesce repeated flushes (fsync still writes synchronously)',
+                    type=float,
+                    default=None)
+parser.add_argument('--writeback-bytes',
+                    metavar='MIB',
+                    help='in write-back mode, dirty MiB that trigger an immediate write-back (default: 64)',
+                    type=int,
+                    default=64)
+parser.add_argument('--io-workers',
+                    metavar='N',
+                    help='threads reading and writing fragment files (default: 8)',
+                    type=int,
+                    default=MixSlice.IO_WORKERS)
+parser.add_argument('--crypto-threads',
+                    metavar='N',
+                    help='threads mixing or unmixing each segment (default: one per CPU)',
+                    type=int,
+                    default=None)
+parser.add_argument('--crypto-processes',
+                    metavar='N',
+                    help='mix and unmix segments in a pool of N processes, so that concurrent opens and flushes do not contend for the interpreter (default: 0, in the FUSE threads)',
+                    type=int,
+                    default=0)
+parser.add_argument('--stream',
+                    metavar='N',
+                    help='mix the segments of files written sequentially in the background as soon as they are complete, with up to N in flight per file, instead of at close (default: 0, disabled)',
+                    type=int,
+                    default=0)
+parser.add_argument('--compress',
+                    metavar='CODEC',
+                    help='compress the segments written with CODEC (zlib, lzma or zstd) before mixing them, unless they do not compress (default: none)',
+                    choices=Compression.CODECS,
+                    default=None)
+parser.add_argument('--cache-size',
+                    metavar='MIB',
+                    help='MiB of decrypted plaintext of closed files to keep in memory for the next open (default: 0)',
+                    type=int,
+                    default=0)
+
+parser.add_argument('--small-size',
+                    metavar='KIB',
+                    help='store files up to KiB as a single SecretBox instead of a Mix&Slice, 0 to disable (default: 16)',
+                    type=int,
+                    default=16)
+parser.add_argument('--readahead',
+                    metavar='N',
+                    help='segments to decrypt in the background ahead of sequential readers, 0 to disable (default: 4)',
+                    type=int,
+                    default=4)
+parser.add_argument('--readahead-size',
+                    metavar='MIB',
+                    help='MiB of segments being decrypted ahead at any time (default: 64)',
+                    type=int,
+                    default=64)
+parser.add_argument('--spill-size',
+                    metavar='MIB',
+                    help='keep the plaintext of open files of MiB or more in memory-mapped temporary files instead of memory (default: never)',
+                    type=int,
+                    default=None)
+parser.add_argument('--plaintext-memory',
+                    metavar='MIB',
+                    help='MiB of plaintext of open files to keep in memory at most, the files beyond are memory-mapped (default: no limit)',
+                    type=int,
+                    default=0)
+parser.add_argument('--spill-dir',
+                    metavar='DIR',
+                    help='folder of the memory-mapped files, e.g. a tmpfs (default: the temporary folder)',
+                    default=None)
+parser.add_argument('--fsync',
+                    help='fsync new fragments before swapping them in, so that flushed files survive a power loss',
+                    action='store_true',
+                    default=False)
+parser.add_argument('--packed',
+                    help='store each new segment as one packed file instead of a folder of fragment files (see packtool.py)',
+                    action='store_true',
+                    default=False)
+parser.add_argument('--verify-open',
+                    help='check the digests of all the segments of a file when it is opened, failing with EIO before any of it is read',
+                    action='store_true',
+                    default=False)
+parser.add_argument('--attr-timeout',
+                    metavar='SECONDS',
+                    help='seconds the kernel may cache file attributes (default: 1)',
+                    type=float,
+                    default=1.0)
+parser.add_argument('--entry-timeout',
+                    metavar='SECONDS',
+                    help='seconds the kernel may cache name lookups (default: 1)',
+                    type=float,
+                    default=1.0)
+parser.add_argument('--kernel-cache',
+                    help='keep the kernel page cache of files across opens (only if DATA is not changed by anything else)',
+                    action='store_true',
+                    default=False)
+password = parser.add_mutually_exclusive_group()
+password.add_argument('--password-fd',
+                      metavar='FD',
+                      help='read the password from the first line of file descriptor FD instead of prompting for it',
+                      type=int,
+                      default=None)
+password.add_argument('--password-env',
+                      metavar='VAR',
+                      help='read the password from the environment variable VAR (removed from the environment once read)',
+                      default=None)
+password.add_argument('--keyfile',
+                      metavar='PATH',
+                      help='use the content of PATH as the password, e.g. a key file or /dev/fd/N',
+                      default=None)
+parser.add_argument('--background-unlock',
+                    help='mount right away and derive the key in the background: operations wait until it is ready',
+                    action='store_true',
+                    default=False)
+parser.add_argument('--kdf-ops',
+                    metavar='N',
+                    help='Argon2id operations of the key derivation of a new volume (default: 4)',
+                    type=int,
+                    default=None)
+parser.add_argument('--kdf-memory',
+                    metavar='MIB',
+                    help='Argon2id memory in MiB of the key derivation of a new volume (default: 1024)',
+                    type=int,
+                    default=None)
+parser.add_argument('--metrics-file',
+                    metavar='PATH',
+                    help='dump the metrics (also readable in MOUNT/.freyafs.metrics) to PATH in the Prometheus text format',
+                    default=None)
+parser.add_argument('--metrics-interval',
+                    metavar='SECONDS',
+                    help='seconds between two dumps of the metrics (default: 10)',
+                    type=float,
+                    default=10.0)
 
 args = parser.parse_args()
 
+
 if __name__ == '__main__':
     data = args.data
     mountpoint = args.mountpoint
 
+    if args.segment_size <= 0:
+        parser.error("--segment-size must be at least 1")
+    if args.small_size * 1024 >= args.segment_size * 1024 * 1024:
+        parser.error("--small-size must be smaller than --segment-size")
+
+    try:
+        password = read_password(args.password_fd, args.password_env, args.keyfile)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.async_frontend:
+        try:
+            import asyncfs
+        except ImportError as e:
+            parser.error(f"--async needs pyfuse3: {e}")
+
+    if args.compress and not Compression.available(args.compress):
+        parser.error(f"--compress {args.compress} needs the zstandard package")
+
     print(f"[*] Mounting FreyaFS...")
 
-    fs = FreyaFS(data, mountpoint)
-    FUSE(fs, mountpoint, nothreads=not args.multithread, foreground=True)
+    MixSlice.set_io_workers(args.io_workers)
+    MixSlice.set_crypto_workers(args.crypto_threads, args.crypto_processes)
+
+    fs = FreyaFS(data, mountpoint,
+                 segment_size=args.segment_size * 1024 * 1024,
+                 writeback_delay=args.writeback,
+                 writeback_bytes=args.writeback_bytes * 1024 * 1024,
+                 cache_bytes=args.cache_size * 1024 * 1024,
+                 small_size=args.small_size * 1024,
+                 readahead=args.readahead,
+                 readahead_bytes=args.readahead_size * 1024 * 1024,
+                 spill_size=args.spill_size * 1024 * 1024 if args.spill_size is not None else None,
+                 memory_bytes=args.plaintext_memory * 1024 * 1024,
+                 spill_dir=args.spill_dir,
+                 fsync=args.fsync,
+                 packed=args.packed,
+                 password=password,
+                 kdf_opslimit=args.kdf_ops,
+                 kdf_memlimit=args.kdf_memory * 1024 * 1024 if args.kdf_memory is not None else None,
+                 background_unlock=args.background_unlock,
+                 verify_open=args.verify_open,
+                 stream=args.stream,
+                 compress=args.compress)
+    if args.metrics_file:
+        METRICS.dump_every(args.metrics_file, args.metrics_interval)
+    if args.async_frontend:
+        asyncfs.serve(asyncfs.AsyncFreyaFS(fs, args.async_workers,
+                                           attr_timeout=args.attr_timeout,
+                                           entry_timeout=args.entry_timeout,
+                                           kernel_cache=args.kernel_cache),
+                      mountpoint)
+    else:
+        FUSE(fs, mountpoint, nothreads=not args.multithread, foreground=True,
+             attr_timeout=args.attr_timeout, entry_timeout=args.entry_timeout,
+             kernel_cache=args.kernel_cache)
 
     print("\n[*] Unmounting FreyaFS...")
     print("[*] FreyaFS unmounted")
-    print("[*] Updating FreyaFS metadata...")
-    fs.metadata.dump()
-    print("[*] FreyaFS metadata updated")
+    print("[*] Writing back cached files...")
+    failed = fs.cache.close()
+    fs.metadata.close()
+    MixSlice.set_crypto_workers()
+    if args.metrics_file:
+        METRICS.dump(args.metrics_file)
+    if failed:
+        print(f"[!] {len(failed)} files could not be written back: their last changes are lost")
+        sys.exit(1)
@@ -1,105 +1,463 @@
 import base64
+import errno
 import getpass
 import json
 import os
+import sqlite3
 import sys
+import threading
 
 import nacl.pwhash
 import nacl.secret
 import nacl.utils
 
+from metrics import METRICS, TimedLock
+
+
+class Segment:
+    def __init__(self, size=0, version=0, digest=None, codec=None):
+        self.size = size  # plaintext bytes stored in the segment
+        self.version = version  # generation of the file that wrote it
+        # Keyed digest of its fragments, None if written before digests
+        self.digest = digest
+        # Codec its plaintext was compressed with before mixing, None if not
+        self.codec = codec
+
 
 class Info:
-    def __init__(self, key=None, iv=None, size=None):
+    def __init__(self, key=None, iv=None, size=None, segment_size=None, segments=None, generation=0,
+                 small=None):
         self.key = key if key is not None else nacl.utils.random(16)
         self.iv = iv if iv is not None else nacl.utils.random(16)
         self.size = size if size is not None else 0
+        # Files written before segmentation are a single MixSlice stored
+        # directly in their folder: they have no segment index
+        self.segment_size = segment_size
+        self.segments = segments
+        # Bumped on every flush, so that a rewritten segment never reuses an iv
+        self.generation = generation
+        # Version of the SecretBox holding a small file, None if not small
+        self.small = small
+        # Node of the file in the metadata index (not part of the record)
+        self.id = None
+
+
+def _segment_dict(segment):
+    record = {'size': segment.size, 'version': segment.version}
+    if segment.digest is not None:
+        record['digest'] = base64.b64encode(segment.digest).decode("ascii")
+    if segment.codec is not None:
+        record['codec'] = segment.codec
+    return record
+
+
+def _segment_from_dict(record):
+    digest = record.get('digest')
+    if digest is not None:
+        digest = base64.b64decode(digest.encode("ascii"))
+    return Segment(record['size'], record['version'], digest, record.get('codec'))
+
+
+def _to_dict(info):
+    record = {
+        'key': base64.b64encode(info.key).decode("ascii"),
+        'iv': base64.b64encode(info.iv).decode("ascii"),
+        'size': info.size
+    }
+    if info.segments is not None:
+        record['segment_size'] = info.segment_size
+        record['segments'] = [_segment_dict(s) for s in info.segments]
+        record['generation'] = info.generation
+    if info.small is not None:
+        record['small'] = info.small
+    return record
+
+
+def _from_dict(record):
+    key = base64.b64decode(record['key'].encode("ascii"))
+    iv = base64.b64decode(record['iv'].encode("ascii"))
+    segments = record.get('segments')
+    if segments is not None:
+        segments = [_segment_from_dict(s) for s in segments]
+    return Info(key, iv, record['size'], record.get('segment_size'), segments,
+                record.get('generation', 0), record.get('small'))
+
+
+def read_password(fd=None, env=None, keyfile=None):
+    """Returns the password read from a file descriptor (its first line), an
+    environment variable (removed once read) or a key file, None if none is
+    given and it must be prompted for."""
+    if fd is not None:
+        with os.fdopen(fd, "rb") as f:
+            return f.readline().rstrip(b"\r\n")
+    if env is not None:
+        if env not in os.environ:
+            raise ValueError(f"the environment variable {env} is not set")
+        return os.environ.pop(env)
+    if keyfile is not None:
+        with open(keyfile, "rb") as f:
+            return f.read()
+    return None
+
 
 class Metadata:
-    def __init__(self, path):
+    """Keys and layout of every file, in an SQLite database of encrypted records.
+
+    The database is a tree of nodes, like the inodes of a filesystem: every
+    node has a parent and a name, folders have no record and files have their
+    encrypted record. Paths are relative to the volume, so DATA can be moved,
+    and renaming a file or a whole folder only updates one node.
+
+    Records are written as soon as they change (add, save, rename, remove), so
+    a crash loses no key, and are only read and decrypted when a file is
+    accessed. The single encrypted JSON blob of older versions is imported the
+    first time the volume is mounted.
+
+    The key is derived from the password with Argon2id, with the salt and the
+    cost stored in clear in the header of the volume (the 'kdf' row), and can
+    be derived in the background while the volume is already mounted.
+    """
+
+    # Plaintext encrypted in the database to check the password
+    CHECK = b"freyafs"
+
+    # Parent of the nodes in the root of the volume
+    ROOT = 0
+
+    # Argon2id cost of the key derivation of new volumes
+    OPSLIMIT = nacl.pwhash.argon2id.OPSLIMIT_SENSITIVE
+    MEMLIMIT = nacl.pwhash.argon2id.MEMLIMIT_SENSITIVE
+
+    # Salt of the volumes created before it was stored in the header
+    LEGACY_SALT = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+
+    def __init__(self, path, password=None, opslimit=None, memlimit=None, background=False):
+        """Opens the metadata of a volume, creating it if needed.
+
+        Args:
+            path (str): The .freyafs path in DATA (the database is next to it).
+            password (str or bytes): The password, prompted for if None.
+            opslimit (int): Argon2id operations of a new volume (default:
+                OPSLIMIT); existing volumes keep the cost in their header.
+            memlimit (int): Argon2id memory in bytes of a new volume
+                (default: MEMLIMIT).
+            background (bool): Derive the key in a thread and return right
+                away: the methods wait until it is ready.
+        """
         self.path = path
+        self.root = os.path.dirname(path)
+        self.db_path = path + ".db"
+        new = not os.path.isfile(path) and not os.path.isfile(self.db_path)
 
-        pw = getpass.getpass("Password: ").encode("utf-8")
-        if not os.path.isfile(path):
+        if isinstance(password, bytes):
+            pw = password
+        elif password is not None:
+            pw = password.encode("utf-8")
+        else:
+            pw = getpass.getpass("Password: ").encode("utf-8")
+        if password is None and new:
             confirm = getpass.getpass("Confirm password: ").encode("utf-8")
             if pw != confirm:
                 print("ERROR: Your password and confirmation password do not match.")
                 sys.exit()
-       
-        salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
-
-        # Generate the key
-        kdf = nacl.pwhash.argon2id.kdf
-        self.key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
-
-        self.metadata = {}
-        if os.path.isfile(path):
-            # Read the encrypted metadata
-            with open(path, 'r') as f:
-                content = f.read()
-                encrypted = base64.b64decode(content)
-
-            # Decrypt metadata
-            box = nacl.secret.SecretBox(self.key)
-            try:
-                plaintext = box.decrypt(encrypted)
-            except nacl.exceptions.CryptoError:
-                print("ERROR: Wrong password.")
-                sys.exit()
 
-            # Read JSON metadata
-            read = json.loads(plaintext)
+        # Nodes already looked up ((parent, name) -> id) and records already
+        # decrypted (id -> Info, None for folders)
+        self._dentries = {}
+        self._infos = {}
+
+        # The connection is shared by the FUSE threads and the write-back thread
+        self._lock = TimedLock("metadata")
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            # Ids are never reused, so that a late save() of a removed file
+            # cannot overwrite another one
+            self._db.execute("CREATE TABLE IF NOT EXISTS nodes "
+                             "(id INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER NOT NULL, "
+                             "name TEXT NOT NULL, info BLOB, UNIQUE (parent, name))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS volume "
+                             "(name TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        header = self._header(new, opslimit, memlimit)
+
+        # Set once the key is derived (or failed to be)
+        self._unlocked = threading.Event()
+        self._failure = None
+        if background:
+            threading.Thread(target=self._unlock, args=(pw, header),
+                             name="freyafs-unlock", daemon=True).start()
+            return
+
+        self._unlock(pw, header)
+        if self._failure is not None:
+            sys.exit()
 
-            # Recreate metadata data structure
-            for path, info in read.items():
-                key = base64.b64decode(info['key'].encode("ascii"))
-                iv = base64.b64decode(info['iv'].encode("ascii"))
-                self.metadata[path] = Info(key, iv, info['size'])
+    # ------------------------------------------------------ Helpers
+
+    def _header(self, new, opslimit, memlimit):
+        """Returns the key derivation parameters stored in the volume, storing
+        them first for a new volume (with a random salt) or an older one."""
+        row = self._db.execute("SELECT value FROM volume WHERE name = 'kdf'").fetchone()
+        if row is not None:
+            header = json.loads(row[0])
+            header['salt'] = base64.b64decode(header['salt'].encode("ascii"))
+            return header
+
+        if new:
+            header = {'salt': nacl.utils.random(nacl.pwhash.argon2id.SALTBYTES),
+                      'opslimit': opslimit or self.OPSLIMIT,
+                      'memlimit': memlimit or self.MEMLIMIT}
+        else:
+            header = {'salt': self.LEGACY_SALT,
+                      'opslimit': nacl.pwhash.argon2id.OPSLIMIT_SENSITIVE,
+                      'memlimit': nacl.pwhash.argon2id.MEMLIMIT_SENSITIVE}
+        record = dict(header, salt=base64.b64encode(header['salt']).decode("ascii"))
+        with self._db:
+            self._db.execute("INSERT INTO volume VALUES ('kdf', ?)",
+                             (json.dumps(record).encode("utf-8"),))
+        return header
+
+    def _unlock(self, pw, header):
+        """Derives the key, checks it and imports the metadata of older
+        versions. Failures are kept for _wait() to raise."""
+        try:
+            kdf = nacl.pwhash.argon2id.kdf
+            self.key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, header['salt'],
+                           opslimit=header['opslimit'], memlimit=header['memlimit'])
+            self.box = nacl.secret.SecretBox(self.key)
+
+            row = self._db.execute("SELECT value FROM volume WHERE name = 'check'").fetchone()
+            if row is not None:
+                self._decrypt(row[0])
+            if os.path.isfile(self.path):
+                self._import_blob(self.path)
+            if self._db.execute("SELECT name FROM sqlite_master "
+                                "WHERE type = 'table' AND name = 'files'").fetchone():
+                self._import_table()
+            if row is None:
+                with self._db:
+                    self._db.execute("INSERT INTO volume VALUES ('check', ?)",
+                                     (self.box.encrypt(self.CHECK),))
+        except PermissionError as e:
+            self._failure = e.strerror
+        except Exception as e:
+            self._failure = f"Could not unlock the metadata: {e}"
+        finally:
+            if self._failure is not None:
+                print(f"ERROR: {self._failure}")
+            self._unlocked.set()
+
+    def _wait(self):
+        """Waits until the key is derived, raises EACCES if it was not."""
+        self._unlocked.wait()
+        if self._failure is not None:
+            raise PermissionError(errno.EACCES, self._failure)
+
+    def _decrypt(self, encrypted):
+        try:
+            return self.box.decrypt(encrypted)
+        except nacl.exceptions.CryptoError:
+            raise PermissionError(errno.EACCES, "Wrong password.")
+
+    def _encrypt(self, info):
+        return self.box.encrypt(json.dumps(_to_dict(info)).encode("utf-8"))
+
+    def _relative(self, path):
+        """Maps an absolute path of an older volume to a path in the volume.
+
+        The volume may have been moved since: the longest tail of the path that
+        is a file of the volume is used.
+        """
+        parts = [part for part in path.split(os.sep) if part]
+        for i in range(len(parts)):
+            relative = "/".join(parts[i:])
+            if os.path.isdir(os.path.join(self.root, relative)):
+                return relative
+        return None
+
+    def _import_blob(self, path):
+        """Moves the records of an encrypted JSON blob into the database."""
+        with open(path, 'r') as f:
+            encrypted = base64.b64decode(f.read())
+        read = json.loads(self._decrypt(encrypted))
+
+        with self._lock, self._db:
+            for old, record in read.items():
+                self._insert(old, self._encrypt(_from_dict(record)))
+        os.remove(path)
+
+    def _import_table(self):
+        """Moves the records of the flat table keyed by absolute path."""
+        with self._lock, self._db:
+            for old, record in self._db.execute("SELECT path, info FROM files").fetchall():
+                self._insert(old, record)
+            self._db.execute("DROP TABLE files")
+
+    def _insert(self, old, record):
+        relative = self._relative(old)
+        if relative is None:
+            print(f"WARNING: {old} is not in the volume anymore, its key is dropped.")
+            return
+        parent = self._lookup(os.path.dirname(relative), create=True)
+        self._db.execute("INSERT OR REPLACE INTO nodes (parent, name, info) VALUES (?, ?, ?)",
+                         (parent, os.path.basename(relative), record))
+
+    def _lookup(self, path, create=False):
+        """Returns the node of path, None if there is none (lock held).
+        With create, the missing folders on the way are added."""
+        node = self.ROOT
+        for name in path.split("/"):
+            if not name:
+                continue
+            child = self._dentries.get((node, name))
+            if child is None:
+                row = self._db.execute("SELECT id FROM nodes WHERE parent = ? AND name = ?",
+                                       (node, name)).fetchone()
+                if row is not None:
+                    child = row[0]
+                elif create:
+                    child = self._db.execute("INSERT INTO nodes (parent, name) VALUES (?, ?)",
+                                             (node, name)).lastrowid
+                else:
+                    return None
+                self._dentries[(node, name)] = child
+            node = child
+        return node
+
+    def _info(self, node, record):
+        """Returns the Info of a node, decrypting its record if needed."""
+        if node not in self._infos:
+            info = None
+            if record is not None:
+                info = _from_dict(json.loads(self._decrypt(record)))
+                info.id = node
+            self._infos[node] = info
+        return self._infos[node]
+
+    def _load(self, path):
+        """Returns the Info of path, None if it is not a file (lock held)."""
+        node = self._lookup(path)
+        if node is None:
+            return None
+        if node not in self._infos:
+            row = self._db.execute("SELECT info FROM nodes WHERE id = ?", (node,)).fetchone()
+            return self._info(node, row[0] if row else None)
+        return self._infos[node]
+
+    def _put(self, path, info, record):
+        """Adds or replaces the record of a file (lock held, in a transaction)."""
+        folder, name = os.path.split(path)
+        parent = self._lookup(folder, create=True)
+        self._forget(parent, name)
+        info.id = self._db.execute(
+            "INSERT OR REPLACE INTO nodes (parent, name, info) VALUES (?, ?, ?)",
+            (parent, name, record)).lastrowid
+        self._dentries[(parent, name)] = info.id
+        self._infos[info.id] = info
+
+    def _forget(self, parent, name):
+        node = self._dentries.pop((parent, name), None)
+        self._infos.pop(node, None)
+
+    # ------------------------------------------------------ Methods
 
     def __contains__(self, path):
-        return path in self.metadata
+        self._wait()
+        with METRICS.timer("metadata_seconds", op="get"), self._lock:
+            return self._load(path) is not None
 
     def __getitem__(self, path):
-        return self.metadata[path]
+        self._wait()
+        with METRICS.timer("metadata_seconds", op="get"), self._lock:
+            info = self._load(path)
+        if info is None:
+            raise KeyError(path)
+        return info
 
-    def add(self, path):
-        info = Info()
-        self.metadata[path] = info
-        return info.key, info.iv
+    def get(self, path):
+        """Returns the Info of a file, None if path is not a file."""
+        self._wait()
+        with METRICS.timer("metadata_seconds", op="get"), self._lock:
+            return self._load(path)
 
-    def update(self, path, size):
-        self.metadata[path].size = size
+    def children(self, path):
+        """Returns the files in a folder (name -> Info), with one query."""
+        self._wait()
+        with METRICS.timer("metadata_seconds", op="children"), self._lock:
+            node = self._lookup(path)
+            if node is None:
+                return {}
+            rows = self._db.execute("SELECT id, name, info FROM nodes WHERE parent = ?",
+                                    (node,)).fetchall()
+            files = {}
+            for child, name, record in rows:
+                self._dentries[(node, name)] = child
+                info = self._info(child, record)
+                if info is not None:
+                    files[name] = info
+        return files
 
-    def renamedir(self, old, new):
-        for path in list(self.metadata):
-            if path.startswith(old):
-                to = path.replace(old, new, 1)
-                self.rename(path, to)
+    def add(self, path, segment_size):
+        self._wait()
+        info = Info(segment_size=segment_size, segments=[])
+        record = self._encrypt(info)
+        with METRICS.timer("metadata_seconds", op="add"), self._lock, self._db:
+            self._put(path, info, record)
+        return info
+
+    def store(self, files):
+        """Adds or replaces the records of many files, (path, Info) pairs, in
+        a single transaction (e.g. for a bulk import)."""
+        self._wait()
+        records = [(path, info, self._encrypt(info)) for path, info in files]
+        with METRICS.timer("metadata_seconds", op="store"), self._lock, self._db:
+            for path, info, record in records:
+                self._put(path, info, record)
+
+    def save(self, info):
+        """Writes the record of a file, wherever it has been moved."""
+        self._wait()
+        with METRICS.timer("metadata_seconds", op="save"):
+            record = self._encrypt(info)
+            with self._lock, self._db:
+                self._db.execute("UPDATE nodes SET info = ? WHERE id = ?", (record, info.id))
+
+    def update(self, path, size):
+        # Saved with the rest of the record when the file is flushed
+        self[path].size = size
 
     def rename(self, old, new):
-        self.metadata[new] = self.metadata[old]
-        del self.metadata[old]
+        """Moves a file, or a folder with everything in it."""
+        self._wait()
+        old_folder, old_name = os.path.split(old)
+        new_folder, new_name = os.path.split(new)
+        with METRICS.timer("metadata_seconds", op="rename"), self._lock, self._db:
+            node = self._lookup(old)
+            if node is None:
+                # A folder without files inside
+                return
+
+            parent = self._lookup(new_folder, create=True)
+            replaced = self._lookup(new)
+            if replaced is not None:
+                self._db.execute("DELETE FROM nodes WHERE id = ?", (replaced,))
+                self._forget(parent, new_name)
+            self._db.execute("UPDATE nodes SET parent = ?, name = ? WHERE id = ?",
+                             (parent, new_name, node))
+            self._dentries.pop((self._lookup(old_folder), old_name), None)
+            self._dentries[(parent, new_name)] = node
 
     def remove(self, path):
-        del self.metadata[path]
-
-    def dump(self):
-        # Convert metadata to JSON-like format
-        to_write = {}
-        for path, info in self.metadata.items():
-            to_write[path] = {
-                'key': base64.b64encode(info.key).decode("ascii"),
-                'iv': base64.b64encode(info.iv).decode("ascii"),
-                'size': info.size
-            }
-        # Produce JSON string
-        plaintext = json.dumps(to_write)
-
-        # Encrypt metadata
-        box = nacl.secret.SecretBox(self.key)
-        encrypted = box.encrypt(plaintext.encode("utf-8"))
-
-        # Store encrypted metadata
-        with open(self.path, 'w') as f:
-            content = base64.b64encode(encrypted).decode("ascii")
-            f.write(content)
+        """Removes a file, or an empty folder."""
+        self._wait()
+        folder, name = os.path.split(path)
+        with METRICS.timer("metadata_seconds", op="remove"), self._lock, self._db:
+            node = self._lookup(path)
+            if node is not None:
+                self._db.execute("DELETE FROM nodes WHERE id = ?", (node,))
+                self._forget(self._lookup(folder), name)
+
+    def close(self):
+        self._unlocked.wait()
+        with self._lock:
+            self._db.close()
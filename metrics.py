@@ -0,0 +1,209 @@
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+           0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    inner = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                     for k, v in pairs)
+    return "%s{%s}" % (name, inner)
+
+
+class Metrics:
+    """Counters and latency histograms of FreyaFS, in memory.
+
+    Every metric has a name and optional labels, e.g.
+    inc("cache_hits_total", kind="segment"). Recording only takes a short
+    lock, so it is always on. render() returns the Prometheus text format.
+    """
+
+    PREFIX = "freyafs_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def take(self):
+        """Returns what was recorded so far and forgets it, e.g. to hand the
+        metrics of a crypto process over to merge() in FreyaFS."""
+        with self._lock:
+            taken = (self.counters, self.histograms)
+            self.counters, self.histograms = {}, {}
+        return taken
+
+    def merge(self, taken):
+        """Adds metrics returned by take() to these."""
+        counters, histograms = taken
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes how long the body takes, even if it raises."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            full = self.PREFIX + name
+            if name in self.help:
+                lines.append(f"# HELP {full} {self.help[name]}")
+            lines.append(f"# TYPE {full} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{_format(full, labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            full = self.PREFIX + name
+            if name in self.help:
+                lines.append(f"# HELP {full} {self.help[name]}")
+            lines.append(f"# TYPE {full} histogram")
+            for (n, labels), (buckets, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, hits in zip(BUCKETS, buckets):
+                    cumulative += hits
+                    lines.append(f"{_format(full + '_bucket', labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{_format(full + '_bucket', labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{_format(full + '_sum', labels)} {total:.9f}")
+                lines.append(f"{_format(full + '_count', labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Writes render() to path, atomically (e.g. for the textfile
+        collector of the Prometheus node exporter)."""
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+    def dump_every(self, path, interval):
+        """Dumps to path every interval seconds, in a daemon thread."""
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"[!] Dump of the metrics to {path} failed: {e}")
+
+        stop = threading.Event()
+        threading.Thread(target=loop, name="freyafs-metrics", daemon=True).start()
+        return stop
+
+
+class TimedLock:
+    """A lock that records how long threads wait to acquire it.
+
+    The wait is only measured when the lock is contended, so an uncontended
+    acquire costs one extra non-blocking attempt. Works as the lock of a
+    threading.Condition.
+    """
+
+    def __init__(self, name, lock=None, metrics=None):
+        self.name = name
+        self._inner = lock if lock is not None else threading.Lock()
+        self._metrics = metrics if metrics is not None else METRICS
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._inner.acquire(False):
+            return True
+        if not blocking:
+            return False
+
+        start = perf_counter()
+        acquired = self._inner.acquire(True, timeout)
+        self._metrics.observe("lock_wait_seconds", perf_counter() - start, lock=self.name)
+        return acquired
+
+    def release(self):
+        self._inner.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# The metrics of the process: MixSlice only has static methods, so the
+# registry is global rather than passed around
+METRICS = Metrics()
+
+METRICS.describe("operation_seconds", "Latency of the FUSE operations")
+METRICS.describe("operation_errors_total", "FUSE operations that failed, by errno")
+METRICS.describe("fragment_io_seconds", "Time spent reading or writing the fragments of a segment")
+METRICS.describe("mix_seconds", "Time spent in mix_and_slice or unslice_and_unmix for a segment")
+METRICS.describe("crypto_process_seconds", "Time spent waiting for a crypto process to mix and store, or load and unmix, a segment")
+METRICS.describe("compression_seconds", "Time spent compressing segments before mixing them, and decompressing them after unmixing")
+METRICS.describe("digest_seconds", "Time spent reading and checking the fragments of a segment against their digest")
+METRICS.describe("metadata_seconds", "Latency of the metadata lookups and writes")
+METRICS.describe("lock_wait_seconds", "Time spent waiting on contended locks")
+METRICS.describe("bytes_decrypted_total", "Plaintext bytes decrypted from DATA")
+METRICS.describe("bytes_encrypted_total", "Plaintext bytes encrypted into DATA")
+METRICS.describe("bytes_served_total", "Bytes returned to read()")
+METRICS.describe("bytes_written_total", "Bytes received by write()")
+METRICS.describe("compression_saved_bytes_total", "Bytes saved by compressing segments before mixing them")
+METRICS.describe("compression_bypassed_total", "Segments stored as is because they did not compress")
+METRICS.describe("digest_errors_total", "Segments whose fragments did not match their digest")
+METRICS.describe("cache_hits_total", "Opens served by the plaintext cache, and reads of already decrypted segments")
+METRICS.describe("cache_misses_total", "Opens that had to load the file, and reads that had to decrypt a segment")
+METRICS.describe("cache_evictions_total", "Closed files dropped from the plaintext cache")
+METRICS.describe("readahead_segments_total", "Segments queued for decryption ahead of a sequential reader")
+METRICS.describe("streamed_segments_total", "Segments of sequential writers mixed in the background before the flush")
+METRICS.describe("spilled_files_total", "Files whose plaintext was moved to a memory-mapped spill file")
+METRICS.describe("writebacks_total", "Files encrypted by a flush or by the write-back thread")
@@ -1,11 +1,23 @@
+import errno as _errno
+import hmac as _hmac
+import mmap as _mmap
+import multiprocessing as _multiprocessing
 import os as _os
 import shutil as _shutil
-from io import BytesIO as _BytesIO
+import tempfile as _tempfile
+import threading as _threading
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool as _BrokenProcessPool
+from hashlib import blake2b as _blake2b
+from struct import Struct as _Struct
 
 from aesmix import mix_and_slice as _mix_and_slice
 from aesmix import unslice_and_unmix as _unslice_and_unmix
 from aesmix.padder import Padder as _Padder
 
+from metrics import METRICS as _metrics
+
 
 class MixSlice:
 
@@ -15,63 +27,432 @@ class MixSlice:
     MINI_PER_MACRO = 1024
     MACRO_SIZE = MINI_SIZE * MINI_PER_MACRO
 
+    SEGMENT_NAME = "seg_%06d.%d"
+
+    # A packed segment is a single file: a header followed by the fragments,
+    # all of the same size, at fixed offsets
+    PACK_SUFFIX = ".pack"
+    PACK_MAGIC = b"FREYAPK1"
+    _PACK_HEADER = _Struct(">8sIQ12x")
+
+    # The fragments of a legacy file (a single MixSlice, straight in the
+    # folder of the file) once packed, in that same folder
+    LEGACY_PACK = "fragments" + PACK_SUFFIX
+
+    # Size of the keyed digest of the fragments of a segment
+    DIGEST_SIZE = 16
+
+    # Prefix of what convert() writes before renaming it into place
+    CONVERT_PREFIX = ".tmp-"
+
+    # Fragment files are read and written by a pool of threads, so that the
+    # open/read/close round trips of the fragments overlap
+    IO_WORKERS = 8
+    _io_pool = None
+    _io_lock = _threading.Lock()
+
+    @staticmethod
+    def set_io_workers(workers):
+        """Sets the number of threads doing fragment I/O (1: no pool)."""
+        assert workers >= 1, "you must use at least one I/O worker"
+        with MixSlice._io_lock:
+            if MixSlice._io_pool is not None:
+                MixSlice._io_pool.shutdown(wait=False)
+                MixSlice._io_pool = None
+            MixSlice.IO_WORKERS = workers
+
+    @staticmethod
+    def _io_map(fn, *iterables):
+        """Maps fn over the fragments, in the I/O pool if there is one."""
+        if MixSlice.IO_WORKERS == 1:
+            return list(map(fn, *iterables))
+
+        with MixSlice._io_lock:
+            if MixSlice._io_pool is None:
+                MixSlice._io_pool = _ThreadPoolExecutor(
+                    max_workers=MixSlice.IO_WORKERS,
+                    thread_name_prefix="freyafs-io")
+            pool = MixSlice._io_pool
+        return list(pool.map(fn, *iterables))
+
+    # Mixing and unmixing: every call runs the aesmix library with this many
+    # native threads (None: one per CPU, which oversubscribes the CPUs when
+    # several files are flushed at once). With CRYPTO_PROCESSES, the calls
+    # (and the fragment I/O around them) run in a pool of processes instead
+    # of the calling thread, and the plaintext goes through shared memory
+    CRYPTO_THREADS = None
+    CRYPTO_PROCESSES = 0
+    SHARED_DIR = "/dev/shm" if _os.path.isdir("/dev/shm") else None
+    _crypto_pool = None
+    _crypto_lock = _threading.Lock()
+
+    @staticmethod
+    def set_crypto_workers(threads=None, processes=0):
+        """Sets the native threads of every mix or unmix (None: one per CPU)
+        and the number of processes running them (0: the calling thread)."""
+        assert threads is None or threads >= 1, "you must use at least one thread"
+        assert processes >= 0, "the number of processes cannot be negative"
+        with MixSlice._crypto_lock:
+            if MixSlice._crypto_pool is not None:
+                MixSlice._crypto_pool.shutdown(wait=True)
+                MixSlice._crypto_pool = None
+            MixSlice.CRYPTO_THREADS = threads
+            MixSlice.CRYPTO_PROCESSES = processes
+
+    @staticmethod
+    def _in_process(fn, *args):
+        # In a crypto process: what fn records there goes back with its result
+        try:
+            return fn(*args), None, _metrics.take()
+        except Exception as e:
+            return None, e, _metrics.take()
+
+    @staticmethod
+    def _crypto_submit(fn, *args):
+        """Runs fn in the crypto processes and returns its result, recording
+        the metrics it recorded there. If a crypto process died (e.g. killed
+        by the OOM killer), the pool is replaced and fn run once more."""
+        for retry in (False, True):
+            with MixSlice._crypto_lock:
+                if MixSlice._crypto_pool is None:
+                    # Not forked: FUSE threads may hold locks at any time
+                    MixSlice._crypto_pool = _ProcessPoolExecutor(
+                        max_workers=MixSlice.CRYPTO_PROCESSES,
+                        mp_context=_multiprocessing.get_context("spawn"),
+                        initializer=MixSlice.set_io_workers,
+                        initargs=(MixSlice.IO_WORKERS,))
+                pool = MixSlice._crypto_pool
+            try:
+                result, error, metrics = pool.submit(MixSlice._in_process, fn, *args).result()
+                break
+            except _BrokenProcessPool:
+                with MixSlice._crypto_lock:
+                    # Other threads may have replaced it already
+                    if MixSlice._crypto_pool is pool:
+                        MixSlice._crypto_pool = None
+                pool.shutdown(wait=False)
+                if retry:
+                    raise
+        _metrics.merge(metrics)
+        if error is not None:
+            raise error
+        return result
+
+    @staticmethod
+    def segment_path(path, index, version):
+        """Returns the folder holding the fragments of a version of a segment."""
+        return _os.path.join(path, MixSlice.SEGMENT_NAME % (index, version))
+
     @staticmethod
-    def encrypt(data, path, key, iv, threads=None, padder=None):
+    def parse_segment(name):
+        """Returns (index, version) for the name of a segment (folder or packed
+        file), None otherwise."""
+        if name.endswith(MixSlice.PACK_SUFFIX):
+            name = name[:-len(MixSlice.PACK_SUFFIX)]
+        if not name.startswith("seg_"):
+            return None
+        try:
+            index, version = name[4:].split(".")
+            return int(index), int(version)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def segment_iv(iv, index, version):
+        """Derives the iv of a version of a segment, so that no two share one."""
+        message = index.to_bytes(8, "big") + version.to_bytes(8, "big")
+        digest = _blake2b(message, key=iv, digest_size=16)
+        return digest.digest()
+
+    @staticmethod
+    def is_fragment(name):
+        return name.startswith("frag_") and name.endswith(".dat")
+
+    @staticmethod
+    def is_packed(path):
+        return path.endswith(MixSlice.PACK_SUFFIX)
+
+    @staticmethod
+    def locate(path):
+        """Returns where the segment stored at path (without suffix) actually
+        is: its packed file if there is one, its folder otherwise."""
+        packed = path + MixSlice.PACK_SUFFIX
+        return packed if _os.path.isfile(packed) else path
+
+    @staticmethod
+    def locate_legacy(path):
+        """Like locate(), for the folder of a legacy file."""
+        packed = _os.path.join(path, MixSlice.LEGACY_PACK)
+        return packed if _os.path.isfile(packed) else path
+
+    @staticmethod
+    def encrypt(data, path, key, iv, threads=None, padder=None, size=None):
         """Creates a MixSlice from plaintext data.
 
         Args:
-            data (bytestr): The data to encrypt (multiple of MACRO_SIZE).
+            data (bytestr): The data to encrypt, or an iterable of chunks
+                that are copied into the padded buffer.
+            path (str): The folder of the fragments, or the packed file if
+                it ends with PACK_SUFFIX.
             key (bytestr): The key used for AES encryption (16 bytes long).
             iv (bytestr): The iv used for AES encryption (16 bytes long).
-            threads (int): The number of threads used. (default: cpu count).
+            threads (int): The number of threads used. (default: CRYPTO_THREADS).
+            size (int): The length of data, if it is an iterable: the
+                padded buffer is then allocated once.
 
         Returns:
-            A new MixSlice that holds the encrypted fragments.
+            The keyed digest of the fragments written (see digest()).
         """
-        padder = padder or _Padder(blocksize=MixSlice.MACRO_SIZE)
-        padded_data = padder.pad(data)
-        fragments = _mix_and_slice(data=padded_data, key=key,
-                                   iv=iv, threads=threads)
-        fragments = [_BytesIO(f) for f in fragments]
+        threads = threads or MixSlice.CRYPTO_THREADS
+        if not MixSlice.CRYPTO_PROCESSES:
+            return MixSlice._mix(MixSlice._pad(data, padder, size), path, key, iv, threads)
+
+        # The padded plaintext is written once, straight into shared memory
+        with _tempfile.NamedTemporaryFile(dir=MixSlice.SHARED_DIR, prefix="freyafs-") as shared:
+            def allocate(length):
+                shared.truncate(length)
+                return _mmap.mmap(shared.fileno(), length)
+
+            padded = MixSlice._pad(data, padder, size, allocate)
+            try:
+                with _metrics.timer("crypto_process_seconds", op="mix"):
+                    return MixSlice._crypto_submit(MixSlice._mix_shared, shared.name,
+                                                   path, key, iv, threads)
+            finally:
+                padded.close()
+
+    @staticmethod
+    def _mix(padded_data, path, key, iv, threads):
+        with _metrics.timer("mix_seconds", op="mix"):
+            # The fragments are views of the output buffer of the library
+            fragments = _mix_and_slice(data=padded_data, key=key,
+                                       iv=iv, threads=threads, to_string=False)
+        MixSlice._store(fragments, path)
+        return MixSlice.digest(fragments, key)
+
+    @staticmethod
+    def _mix_shared(name, path, key, iv, threads):
+        # In a crypto process: the padded plaintext is in the shared file name
+        with open(name, "r+b") as shared, _mmap.mmap(shared.fileno(), 0) as mapped:
+            with memoryview(mapped) as padded_data:
+                return MixSlice._mix(padded_data, path, key, iv, threads)
+
+    @staticmethod
+    def digest(fragments, key):
+        """Returns the keyed digest of the fragments of a segment, in order.
+
+        It is keyed with the key of the file, so that it can be checked
+        without unmixing the segment, but not forged without the key.
+        """
+        digest = _blake2b(key=key, digest_size=MixSlice.DIGEST_SIZE,
+                          person=b"freyafs-segment")
+        for fragment in fragments:
+            digest.update(fragment)
+        return digest.digest()
+
+    @staticmethod
+    def verify(path, key, digest):
+        """Checks the fragments of a segment against their digest, without
+        unmixing them, and returns them. Raises OSError(EIO) if they do not
+        match; with no digest, only checks that they can all be read."""
+        with _metrics.timer("digest_seconds"):
+            fragments = MixSlice._load(path)
+            if digest is not None and \
+                    not _hmac.compare_digest(MixSlice.digest(fragments, key), digest):
+                _metrics.inc("digest_errors_total")
+                raise OSError(_errno.EIO, "the fragments do not match their digest", path)
+        return fragments
+
+    @staticmethod
+    def _store(fragments, path):
+        if MixSlice.is_packed(path):
+            with _metrics.timer("fragment_io_seconds", op="write", layout="packed"):
+                MixSlice._write_pack(path, fragments)
+            return
 
         if not _os.path.exists(path):
             _os.makedirs(path)
 
         name = "frag_%%0%dd.dat" % len(str(len(fragments)))
-        for fragid in range(len(fragments)):
-            fragment = fragments[fragid]
-            assert isinstance(fragment, _BytesIO)
-            fragment.seek(0)
-            destination = _os.path.join(path, name % fragid)
-            with open(destination, "wb") as fp:
-                _shutil.copyfileobj(fragment, fp)
-            fragment.close()
+        destinations = [_os.path.join(path, name % fragid)
+                        for fragid in range(len(fragments))]
+        with _metrics.timer("fragment_io_seconds", op="write", layout="folder"):
+            MixSlice._io_map(MixSlice._write_fragment, destinations, fragments)
 
     @staticmethod
-    def _read_fragment(fragment):
-        if isinstance(fragment, _BytesIO):
-            fragment.seek(0)
-            data = fragment.read()
-            fragment.seek(0)
+    def _load(path):
+        if MixSlice.is_packed(path):
+            with _metrics.timer("fragment_io_seconds", op="read", layout="packed"):
+                return MixSlice._read_pack(path)
+
+        with _metrics.timer("fragment_io_seconds", op="read", layout="folder"):
+            files = sorted(f for f in _os.listdir(path) if MixSlice.is_fragment(f))
+            assert len(files) == MixSlice.MINI_PER_MACRO, \
+                "exactly MINI_PER_MACRO files required in path."
+            filenames = [_os.path.join(path, f) for f in files]
+            return MixSlice._io_map(MixSlice._read_fragment, filenames)
+
+    @staticmethod
+    def _write_pack(path, fragments):
+        folder = _os.path.dirname(path)
+        if folder and not _os.path.exists(folder):
+            _os.makedirs(folder)
+
+        size = len(fragments[0])
+        with open(path, "wb", buffering=0) as fp:
+            fp.write(MixSlice._PACK_HEADER.pack(MixSlice.PACK_MAGIC, len(fragments), size))
+            for fragment in fragments:
+                fp.write(fragment)
+
+    @staticmethod
+    def _read_pack(path):
+        header_size = MixSlice._PACK_HEADER.size
+        fd = _os.open(path, _os.O_RDONLY)
+        try:
+            header = _os.pread(fd, header_size, 0)
+            if len(header) != header_size:
+                raise ValueError(f"{path}: not a packed segment")
+            magic, count, size = MixSlice._PACK_HEADER.unpack(header)
+            if magic != MixSlice.PACK_MAGIC or count != MixSlice.MINI_PER_MACRO:
+                raise ValueError(f"{path}: not a packed segment")
+            data = _os.pread(fd, count * size, header_size)
+        finally:
+            _os.close(fd)
+
+        if len(data) != count * size:
+            raise ValueError(f"{path}: truncated packed segment")
+        view = memoryview(data)
+        return [view[i * size:(i + 1) * size] for i in range(count)]
+
+    @staticmethod
+    def convert(source, destination):
+        """Copies the fragments of a segment from a layout to the other (a
+        folder or a packed file, according to the names), without decrypting
+        them. The destination is written aside and renamed into place, unless
+        it is the folder of a legacy file, which the fragments go straight to."""
+        if _os.path.isdir(destination):
+            MixSlice._store(MixSlice._load(source), destination)
+            MixSlice.fsync([destination])
+            return
+
+        folder, name = _os.path.split(destination)
+        staging = _os.path.join(folder, MixSlice.CONVERT_PREFIX + name)
+        if _os.path.isdir(staging):
+            _shutil.rmtree(staging)
+
+        MixSlice._store(MixSlice._load(source), staging)
+        MixSlice.fsync([staging])
+        _os.rename(staging, destination)
+        MixSlice._fsync_path(folder or ".")
+
+    @staticmethod
+    def _pad(data, padder=None, size=None, allocate=bytearray):
+        """Pads data (bytes-like or iterable of chunks) into a new buffer,
+        allocate(length) (by default a bytearray).
+
+        The padding only depends on the length of the data modulo the block
+        size, so it is computed on the tail alone instead of copying the whole
+        plaintext into the padder. When the length is known, the buffer is
+        allocated once at its padded size and every chunk is copied in place.
+        """
+        padder = padder or _Padder(blocksize=MixSlice.MACRO_SIZE)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            data = (data,)
+
+        if size is None:
+            padded = bytearray()
+            for chunk in data:
+                padded += chunk
+            size = len(padded)
         else:
-            with open(fragment, "rb") as fp:
-                data = fp.read()
-        return data
+            padded = None
+
+        tail = size % MixSlice.MACRO_SIZE
+        padding = padder.pad(bytes(tail))[tail:]
+        if padded is not None:
+            padded += padding
+            if allocate is bytearray:
+                return padded
+            data = (padded,)
+            size, padding = len(padded), b''
+
+        padded = allocate(size + len(padding))
+        with memoryview(padded) as view:
+            offset = 0
+            for chunk in data:
+                view[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            assert offset == size, "data is not as long as its size"
+            view[size:] = padding
+        return padded
 
     @staticmethod
-    def decrypt(path, key, iv, threads=None, padder=None):
+    def fsync(paths):
+        """Flushes to stable storage some packed segments, or the fragments in
+        some folders and the folders themselves, all in one batch through the
+        I/O pool."""
+        files = [_os.path.join(path, f) for path in paths if _os.path.isdir(path)
+                 for f in _os.listdir(path) if MixSlice.is_fragment(f)]
+        MixSlice._io_map(MixSlice._fsync_path, files + list(paths))
 
-        files = sorted(_os.listdir(path))
-        assert len(files) == MixSlice.MINI_PER_MACRO, \
-            "exactly MINI_PER_MACRO files required in path."
-        filenames = [_os.path.join(path, f) for f in files]
-        fragments = [MixSlice._read_fragment(f) for f in filenames]
+    @staticmethod
+    def _fsync_path(path):
+        fd = _os.open(path, _os.O_RDONLY)
+        try:
+            _os.fsync(fd)
+        finally:
+            _os.close(fd)
 
-        padded_data = _unslice_and_unmix(
-            fragments=fragments,
-            key=key,
-            iv=iv,
-            threads=threads)
+    @staticmethod
+    def _write_fragment(destination, fragment):
+        # The fragments are memoryviews of the mixed buffer: no copy needed
+        with open(destination, "wb") as fp:
+            fp.write(fragment)
 
+    @staticmethod
+    def _read_fragment(fragment):
+        with open(fragment, "rb") as fp:
+            data = fp.read()
+        return data
+
+    @staticmethod
+    def decrypt(path, key, iv, threads=None, padder=None, digest=None):
+        """Returns the plaintext of a MixSlice, checking its fragments first
+        if their digest is given (OSError(EIO) if they do not match)."""
+        threads = threads or MixSlice.CRYPTO_THREADS
+        if not MixSlice.CRYPTO_PROCESSES:
+            padded_data = MixSlice._unmix(path, key, iv, threads, digest)
+        else:
+            with _tempfile.NamedTemporaryFile(dir=MixSlice.SHARED_DIR, prefix="freyafs-") as shared:
+                with _metrics.timer("crypto_process_seconds", op="unmix"):
+                    MixSlice._crypto_submit(MixSlice._unmix_shared, shared.name,
+                                            path, key, iv, threads, digest)
+                # The mapping outlives the file, unlinked when it is closed
+                padded_data = memoryview(_mmap.mmap(shared.fileno(), 0))
+
+        # A view of the output buffer, without the padding
         padder = padder or _Padder(blocksize=MixSlice.MACRO_SIZE)
         return padder.unpad(padded_data)
+
+    @staticmethod
+    def _unmix(path, key, iv, threads, digest=None):
+        if digest is not None:
+            fragments = MixSlice.verify(path, key, digest)
+        else:
+            fragments = MixSlice._load(path)
+
+        with _metrics.timer("mix_seconds", op="unmix"):
+            return memoryview(_unslice_and_unmix(
+                fragments=fragments,
+                key=key,
+                iv=iv,
+                threads=threads,
+                to_string=False))
+
+    @staticmethod
+    def _unmix_shared(name, path, key, iv, threads, digest):
+        # In a crypto process: the padded plaintext goes to the shared file name
+        padded_data = MixSlice._unmix(path, key, iv, threads, digest)
+        with open(name, "r+b") as shared:
+            shared.write(padded_data)
@@ -0,0 +1,105 @@
+# FreyaFS PACK TOOL
+# Moves the segments of a FreyaFS volume between the two layouts: a folder of
+# MINI_PER_MACRO fragment files, or a single packed file. The fragments of a
+# legacy file, straight in its folder, are packed into MixSlice.LEGACY_PACK in
+# that same folder. The fragments are copied as they are, so no password is
+# needed. Run it on unmounted volumes:
+#   python packtool.py pack DATA
+#   python packtool.py unpack DATA
+#   python packtool.py export SEGMENT DEST
+
+import os
+import shutil
+from argparse import ArgumentParser
+
+from cache import STAGING
+from mixslice import MixSlice
+
+
+def segments(root):
+    """Yields the path of every segment (folder or packed file) in a volume,
+    legacy files included."""
+    for folder, dirnames, filenames in os.walk(root):
+        if any(MixSlice.is_fragment(name) for name in filenames):
+            yield folder
+        for name in dirnames + filenames:
+            path = os.path.join(folder, name)
+            if name.startswith(MixSlice.CONVERT_PREFIX):
+                # Leftover of an interrupted conversion
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            elif MixSlice.parse_segment(name) is not None or name == MixSlice.LEGACY_PACK:
+                yield path
+        # Segment folders only hold fragments, staged segments are swept at open
+        dirnames[:] = [d for d in dirnames
+                       if MixSlice.parse_segment(d) is None and d != STAGING]
+
+
+def pack(root):
+    count = 0
+    for path in list(segments(root)):
+        if MixSlice.is_packed(path):
+            continue
+        legacy = MixSlice.parse_segment(os.path.basename(path)) is None
+        packed = os.path.join(path, MixSlice.LEGACY_PACK) if legacy else path + MixSlice.PACK_SUFFIX
+        # A packed file is only there once complete: the fragments are leftovers
+        if not os.path.exists(packed):
+            MixSlice.convert(path, packed)
+            count += 1
+        if legacy:
+            # The folder of a legacy file is the folder of the file itself
+            for name in os.listdir(path):
+                if MixSlice.is_fragment(name):
+                    os.remove(os.path.join(path, name))
+        else:
+            shutil.rmtree(path)
+    return count
+
+
+def unpack(root):
+    count = 0
+    for path in list(segments(root)):
+        if not MixSlice.is_packed(path):
+            continue
+        if os.path.basename(path) == MixSlice.LEGACY_PACK:
+            # Back into the folder of the legacy file, over any leftover
+            folder = os.path.dirname(path)
+        else:
+            folder = path[:-len(MixSlice.PACK_SUFFIX)]
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+        MixSlice.convert(path, folder)
+        os.remove(path)
+        count += 1
+    return count
+
+
+def main():
+    parser = ArgumentParser(description="FreyaFS pack tool")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('pack', help='pack every segment folder of a volume')
+    command.add_argument('data', metavar='DATA', help='folder containing your encrypted files')
+
+    command = commands.add_parser('unpack', help='turn every packed segment of a volume back into a folder')
+    command.add_argument('data', metavar='DATA', help='folder containing your encrypted files')
+
+    command = commands.add_parser('export', help='write the fragments of a segment as a folder of fragment files')
+    command.add_argument('segment', metavar='SEGMENT', help='segment to export (a seg_* folder or packed file)')
+    command.add_argument('dest', metavar='DEST', help='folder to create')
+
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        print(f"[*] Packed {pack(args.data)} segments")
+    elif args.command == 'unpack':
+        print(f"[*] Unpacked {unpack(args.data)} segments")
+    else:
+        MixSlice.convert(args.segment, args.dest.rstrip("/"))
+        print(f"[*] Fragments of {args.segment} exported to {args.dest}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os as _os
+from hashlib import blake2b as _blake2b
+
+import nacl.secret as _secret
+
+
+class SmallFile:
+    """Files too small to be worth a MixSlice, stored as a single SecretBox.
+
+    Mix&Slice pads every segment to a full macro block and spreads it over
+    MINI_PER_MACRO fragments: for a file of a few bytes that is mostly
+    overhead. Small files are instead encrypted as a whole into one file of
+    their folder, named after the generation that wrote it.
+    """
+
+    NAME = "small.%d"
+
+    @staticmethod
+    def path(path, version):
+        """Returns the file holding a version of a small file."""
+        return _os.path.join(path, SmallFile.NAME % version)
+
+    @staticmethod
+    def parse(name):
+        """Returns the version of a small file name, None otherwise."""
+        if not name.startswith("small."):
+            return None
+        try:
+            return int(name[6:])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _box(key, version):
+        # Each version has its own key: an older blob put in place of the
+        # current one does not decrypt
+        box_key = _blake2b(version.to_bytes(8, "big"), key=key,
+                           digest_size=_secret.SecretBox.KEY_SIZE).digest()
+        return _secret.SecretBox(box_key)
+
+    @staticmethod
+    def encrypt(data, path, key, version):
+        """Encrypts data (bytes-like or iterable of chunks) into path."""
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = (data,)
+        plaintext = b''.join(data)
+
+        folder = _os.path.dirname(path)
+        if folder and not _os.path.exists(folder):
+            _os.makedirs(folder)
+        with open(path, "wb") as fp:
+            fp.write(SmallFile._box(key, version).encrypt(plaintext))
+
+    @staticmethod
+    def decrypt(path, key, version):
+        with open(path, "rb") as fp:
+            encrypted = fp.read()
+        return SmallFile._box(key, version).decrypt(encrypted)
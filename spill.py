@@ -0,0 +1,60 @@
+import mmap
+import tempfile
+
+# Pages of a spill file are mapped this many at a time: mappings are never
+# resized, because views of their pages are handed out
+ARENA_PAGES = 512
+
+
+class Spill:
+    """Fixed-size pages of plaintext in a memory-mapped temporary file.
+
+    The pages of a large file live in a shared mapping of a file that is
+    unlinked as soon as it is created: the kernel writes them out to the file
+    under memory pressure instead of the process being killed, and drops
+    everything once the mapping is garbage collected. Put the directory on
+    tmpfs to keep the pages in RAM (and swap), or on a disk otherwise.
+
+    Not thread-safe: it belongs to the FileByteContent using it, which
+    serializes the calls.
+    """
+
+    def __init__(self, page_size, directory=None):
+        self.page_size = page_size
+        self.directory = directory
+        self._file = None
+        self._arenas = []
+        self._free = []
+
+    def _grow(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.directory)
+        arena_size = ARENA_PAGES * self.page_size
+        offset = len(self._arenas) * arena_size
+        self._file.truncate(offset + arena_size)
+        self._arenas.append(mmap.mmap(self._file.fileno(), arena_size, offset=offset))
+        first = len(self._arenas) * ARENA_PAGES - 1
+        self._free.extend(range(first, first - ARENA_PAGES, -1))
+
+    def _view(self, page):
+        arena, index = divmod(page, ARENA_PAGES)
+        start = index * self.page_size
+        return memoryview(self._arenas[arena])[start:start + self.page_size]
+
+    def allocate(self):
+        """Returns (page, a writable view of it), zero-filled."""
+        if not self._free:
+            self._grow()
+        page = self._free.pop()
+        return page, self._view(page)
+
+    def free(self, page):
+        """Returns a page, zeroing it (and giving its space back if the
+        filesystem can punch holes)."""
+        arena, index = divmod(page, ARENA_PAGES)
+        start = index * self.page_size
+        try:
+            self._arenas[arena].madvise(mmap.MADV_REMOVE, start, self.page_size)
+        except (AttributeError, OSError):
+            self._view(page)[:] = bytes(self.page_size)
+        self._free.append(page)
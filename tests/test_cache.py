@@ -0,0 +1,219 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import cache as cache_module
+from cache import Cache
+from metadata import Info
+from mixslice import MixSlice
+
+MIB = 1024 * 1024
+
+
+class WriteBackTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="freyafs-test-")
+        self.path = os.path.join(self.root, "file")
+        self.info = Info(segment_size=MIB, segments=[])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_reopen_during_write_back(self):
+        """A file released and opened again while its write-back encrypts it
+        keeps its plaintext and its staged segments."""
+        cache = Cache(segment_size=MIB, writeback_delay=0.01)
+        started, resume = threading.Event(), threading.Event()
+        encrypt = cache._encrypt
+
+        def slow_encrypt(entry):
+            started.set()
+            resume.wait()
+            return encrypt(entry)
+
+        cache._encrypt = slow_encrypt
+        data = os.urandom(3 * MIB)
+        cache.create(self.path, self.info)
+        cache.write_bytes(self.path, data, 0)
+        cache.flush(self.path)
+        self.assertTrue(started.wait(10))
+
+        cache.release(self.path)
+        reopen = threading.Thread(target=cache.open,
+                                  args=(self.path, self.info, os.lstat(self.path).st_mtime))
+        reopen.start()
+        reopen.join(0.2)
+        resume.set()
+        reopen.join()
+
+        self.assertEqual(bytes(cache.read_bytes(self.path, 0, len(data))), data)
+        cache.release(self.path)
+        cache.close()
+        self.assertEqual(sum(s.size for s in self.info.segments), len(data))
+
+    def _write(self, cache, data):
+        cache.create(self.path, self.info)
+        cache.write_bytes(self.path, data, 0)
+        cache.flush(self.path)
+        cache.release(self.path)
+
+    @mock.patch.object(cache_module, "WRITEBACK_RETRY", 0.01)
+    def test_write_back_retried_after_error(self):
+        """Any error of a write-back, not just OSError, is retried later."""
+        saved = []
+
+        def persist(info):
+            if len(saved) < 2:
+                saved.append(None)
+                raise sqlite3.OperationalError("database is locked")
+            saved.append(sum(s.size for s in info.segments))
+
+        cache = Cache(segment_size=MIB, writeback_delay=0.01, persist=persist)
+        self._write(cache, os.urandom(2 * MIB))
+        deadline = time.monotonic() + 10
+        while len(saved) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(cache._flusher.is_alive())
+        self.assertEqual(cache.close(), [])
+        self.assertEqual(saved[-1], 2 * MIB)
+
+    def test_failed_flush_stays_out_of_the_lru(self):
+        """A file whose flush failed is kept until it is written, not put in
+        the LRU of clean files."""
+        failures = []
+
+        def persist(info):
+            if failures:
+                raise failures.pop()
+
+        cache = Cache(segment_size=MIB, cache_bytes=MIB, persist=persist)
+        cache.create(self.path, self.info)
+        failures.append(sqlite3.OperationalError("database is locked"))
+        cache.write_bytes(self.path, os.urandom(2 * MIB), 0)
+        with self.assertRaises(sqlite3.OperationalError):
+            cache.flush(self.path)
+        cache.release(self.path)
+
+        self.assertIn(self.path, cache)
+        self.assertNotIn(self.path, cache.idle)
+        self.assertEqual(cache.close(), [])
+        self.assertEqual(sum(s.size for s in self.info.segments), 2 * MIB)
+
+    def test_close_reports_unwritten_files(self):
+        def persist(info):
+            raise sqlite3.OperationalError("database is locked")
+
+        cache = Cache(segment_size=MIB, writeback_delay=60, persist=persist)
+        self._write(cache, os.urandom(MIB))
+        self.assertEqual(cache.close(), [self.path])
+
+
+class SmallFileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="freyafs-test-")
+        self.path = os.path.join(self.root, "file")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_small_size_smaller_than_segment(self):
+        with self.assertRaises(ValueError):
+            Cache(segment_size=MIB, small_size=MIB)
+
+    def test_partial_write_keeps_unloaded_segments(self):
+        """A file with segments never decrypted is not flushed as a SecretBox,
+        which would only hold what was loaded."""
+        segment_size = 64 * 1024
+        cache = Cache(segment_size=segment_size, small_size=0)
+        info = Info(segment_size=segment_size, segments=[])
+        data = bytearray(os.urandom(3 * segment_size))
+        cache.create(self.path, info)
+        cache.write_bytes(self.path, bytes(data), 0)
+        cache.flush(self.path)
+        cache.release(self.path)
+
+        # Set past the check of __init__, as small_size >= segment_size was
+        cache.small_size = 4 * segment_size
+        cache.open(self.path, info, os.lstat(self.path).st_mtime)
+        cache.write_bytes(self.path, b"x", 0)
+        data[0:1] = b"x"
+        cache.flush(self.path)
+        cache.release(self.path)
+
+        self.assertIsNone(info.small)
+        cache.open(self.path, info, os.lstat(self.path).st_mtime)
+        self.assertEqual(bytes(cache.read_bytes(self.path, 0, len(data))), bytes(data))
+        cache.release(self.path)
+        cache.close()
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="freyafs-test-")
+        self.path = os.path.join(self.root, "file")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_iv_never_reused(self):
+        """Segments streamed and then written again or truncated away never
+        leave their iv to the segments mixed at flush."""
+        # Only segments made of whole chunks are streamed
+        segment_size = 2 * cache_module.CHUNK_SIZE
+        ivs = []
+        encrypt = MixSlice.encrypt
+
+        def record(data, path, key, iv, **kwargs):
+            ivs.append(iv)
+            return encrypt(data, path, key, iv, **kwargs)
+
+        cache = Cache(segment_size=segment_size, small_size=0, stream=2)
+        info = Info(segment_size=segment_size, segments=[])
+        with mock.patch.object(MixSlice, "encrypt", staticmethod(record)):
+            cache.create(self.path, info)
+            data = os.urandom(4 * segment_size)
+            for offset in range(0, len(data), segment_size):
+                cache.write_bytes(self.path, data[offset:offset + segment_size], offset)
+            cache.write_bytes(self.path, b"x", 0)
+            cache.truncate_bytes(self.path, segment_size + 1)
+            cache.flush(self.path)
+            cache.release(self.path)
+            cache.close()
+
+        self.assertGreater(len(ivs), 2)
+        self.assertEqual(len(set(ivs)), len(ivs))
+
+
+class SpillTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="freyafs-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_memory_bytes(self):
+        """Files that would take the plaintext in memory past memory_bytes
+        are spilled, and the plaintext counted goes with the files."""
+        cache = Cache(segment_size=MIB, memory_bytes=2 * MIB, spill_dir=self.root)
+        paths = [os.path.join(self.root, name) for name in ("a", "b")]
+        for path, size in zip(paths, (3 * MIB // 2, MIB)):
+            cache.create(path, Info(segment_size=MIB, segments=[]))
+            cache.write_bytes(path, os.urandom(size), 0)
+
+        self.assertIsNone(cache.files[paths[0]].content.spill)
+        self.assertIsNotNone(cache.files[paths[1]].content.spill)
+        self.assertEqual(cache.memory_used, 3 * MIB // 2)
+        for path in paths:
+            cache.flush(path)
+            cache.release(path)
+        self.assertEqual(cache.memory_used, 0)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import errno
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from metrics import METRICS
+from mixslice import MixSlice
+
+
+def _count(name, **labels):
+    histogram = METRICS.histograms.get((name, tuple(sorted(labels.items()))))
+    return histogram[2] if histogram is not None else 0
+
+
+class CryptoProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="freyafs-test-")
+        MixSlice.set_crypto_workers(threads=1, processes=1)
+
+    def tearDown(self):
+        MixSlice.set_crypto_workers()
+        shutil.rmtree(self.root)
+
+    def test_metrics_of_crypto_processes(self):
+        """What the crypto processes record ends up in the metrics of FreyaFS."""
+        key, iv = os.urandom(16), os.urandom(16)
+        path = os.path.join(self.root, "segment")
+        mixed, unmixed = _count("mix_seconds", op="mix"), _count("mix_seconds", op="unmix")
+        errors = METRICS.counters.get(("digest_errors_total", ()), 0)
+
+        data = os.urandom(3 * MixSlice.MACRO_SIZE)
+        digest = MixSlice.encrypt(data, path, key, iv)
+        self.assertEqual(bytes(MixSlice.decrypt(path, key, iv, digest=digest)), data)
+        self.assertEqual(_count("mix_seconds", op="mix"), mixed + 1)
+        self.assertEqual(_count("mix_seconds", op="unmix"), unmixed + 1)
+
+        with self.assertRaises(OSError) as raised:
+            MixSlice.decrypt(path, key, iv, digest=bytes(MixSlice.DIGEST_SIZE))
+        self.assertEqual(raised.exception.errno, errno.EIO)
+        self.assertEqual(METRICS.counters.get(("digest_errors_total", ()), 0), errors + 1)
+
+    def test_crypto_process_killed(self):
+        """A crypto process that died is replaced, and the work it lost done
+        again."""
+        key, iv = os.urandom(16), os.urandom(16)
+        path = os.path.join(self.root, "segment")
+        data = os.urandom(MixSlice.MACRO_SIZE)
+        MixSlice.encrypt(data, path, key, iv)
+
+        pool = MixSlice._crypto_pool
+        for process in list(pool._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        self.assertEqual(bytes(MixSlice.decrypt(path, key, iv)), data)
+        self.assertIsNot(MixSlice._crypto_pool, pool)
+
+
+if __name__ == '__main__':
+    unittest.main()